@@ -1,13 +1,29 @@
-import subprocess
 import argparse
 import json
 import jenkins
 import tarfile
 import os
 import requests
+import urllib3
 import shutil
 import re
+import fnmatch
 import sys
+import io
+import threading
+import hashlib
+import contextlib
+import time
+import uuid
+import queue
+import gzip
+import zlib
+import collections
+import zipfile
+import heapq
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, \
+    wait, FIRST_COMPLETED
 
 
 def printError(*args):
@@ -47,6 +63,932 @@ def queryYesNo(question, default="yes"):
                              "(or 'y' or 'n').\n")
 
 
+class TemplateCache:
+
+    """
+    Job templates pulled from the server, every template is fetched at most
+    once per process. When a cache directory is given the templates are also
+    kept on disk, and the first use in a process only revalidates the copy on
+    disk with a conditional request on its ETag. Servers that do not send an
+    ETag get the template body fetched again and compared by hash.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, server, template_name):
+        """
+        Return the configuration xml of template_name on server
+        """
+        url = JenkinsJob.jobUrl(server.server, template_name) + 'config.xml'
+        with self.lock:
+            if url in self.templates:
+                self.hits += 1
+            else:
+                print("Pulling job template from jenkins %s" % (template_name))
+                self.templates[url] = self.__fetch__(server, url)
+            return self.templates[url]
+
+    def summary(self):
+        return "Template cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def __fetch__(self, server, url):
+        entry_path = None
+        entry = None
+        if self.cache_dir != None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry_path = self.cache_dir + '/' + \
+                hashlib.sha1(url.encode()).hexdigest() + '.json'
+            if os.path.isfile(entry_path):
+                with open(entry_path, 'r') as entry_fp:
+                    entry = json.load(entry_fp)
+
+        headers = {}
+        if entry != None and entry['etag'] != None:
+            headers['If-None-Match'] = entry['etag']
+        response = server.jenkins_request(
+            requests.Request('GET', url, headers=headers))
+        if response.status_code == 304:
+            self.hits += 1
+            return entry['config']
+
+        self.misses += 1
+        config = response.text
+        digest = hashlib.sha256(config.encode()).hexdigest()
+        if entry_path != None and (entry == None or entry['sha256'] != digest):
+            with open(entry_path, 'w') as entry_fp:
+                json.dump({
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'sha256': digest,
+                    'config': config
+                }, entry_fp)
+        return config
+
+
+class ParallelGzipWriter:
+
+    """
+    Writer that compresses fixed size blocks on a pool of threads and writes
+    each block to fileobj as a gzip member of its own, in order. A series of
+    gzip members is a valid gzip stream (the same framing pigz can emit), so
+    gzip, pigz and tar -xzf read the output as a single archive.
+    """
+
+    def __init__(self, fileobj, level=6, block_size=1024 * 1024, workers=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers if workers != None else (os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def __compress__(self, block):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+
+    def __submit__(self, block):
+        self.pending.append(self.executor.submit(self.__compress__, block))
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.__submit__(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self.__submit__(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+class Compression:
+
+    """
+    Compression backend of the submission archives:
+      gzip  - a single gzip stream at the given level (9 is what tarfile uses)
+      pgzip - blocks compressed in parallel by ParallelGzipWriter
+      none  - a plain tar, cheapest when the network is faster than gzip
+    jenkins.sh and template.xml extract with tar -xf, which detects the
+    compression. Jobs are configured from the template on the server though,
+    and a server template still extracting with tar -xzf rejects a plain tar,
+    so none needs the server template to be updated first.
+    """
+
+    BACKENDS = ['gzip', 'pgzip', 'none']
+
+    class Plain:
+
+        def __init__(self, fileobj):
+            self.fileobj = fileobj
+
+        def write(self, data):
+            return self.fileobj.write(data)
+
+        def close(self):
+            pass
+
+    def __init__(self, backend='gzip', level=9, workers=None):
+        if not backend in Compression.BACKENDS:
+            raise ValueError("invalid compression backend '%s'" % backend)
+        self.backend = backend
+        self.level = level
+        self.workers = workers
+
+    def __str__(self):
+        if self.backend == 'none':
+            return self.backend
+        return "%s-%d" % (self.backend, self.level)
+
+    def suffix(self):
+        return '.tar' if self.backend == 'none' else '.tar.gz'
+
+    def open(self, fileobj):
+        """
+        Writer compressing into fileobj, closing it does not close fileobj
+        """
+        if self.backend == 'gzip':
+            return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=self.level)
+        elif self.backend == 'pgzip':
+            return ParallelGzipWriter(fileobj, self.level, workers=self.workers)
+        else:
+            return Compression.Plain(fileobj)
+
+    def archive(self, fileobj, base_dir, paths):
+        """
+        Write the archive of paths, relative to base_dir, into fileobj. The
+        members are named after the paths.
+        """
+        compressor = self.open(fileobj)
+        try:
+            with tarfile.open(fileobj=compressor, mode='w|') as tar_handle:
+                for path in paths:
+                    if os.path.exists(os.path.join(base_dir, path)):
+                        tar_handle.add(os.path.join(base_dir, path),
+                                       arcname=path, recursive=True)
+        finally:
+            compressor.close()
+
+
+class ArchiveCache:
+
+    """
+    Submission archives kept in cache_dir and keyed by the sources they were
+    made of: the path, size and modification time of every file and,
+    optionally, a hash of the file contents. Jobs that share a source
+    directory reuse one archive. The least recently used archives are evicted
+    when the cache grows over max_bytes, archives in use are never evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=8 * 1024 ** 3, hash_contents=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.in_use = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, base_dir, paths, variant=''):
+        """
+        Hash of the files and directories under paths, relative to base_dir,
+        and of variant (e.g., how they are compressed)
+        """
+        digest = hashlib.sha256(variant.encode())
+
+        def addEntry(rel_path):
+            stat = os.stat(os.path.join(base_dir, rel_path))
+            digest.update(('%s\0%d\0%d\0' % (
+                rel_path, stat.st_size, stat.st_mtime_ns)).encode())
+            if self.hash_contents and os.path.isfile(os.path.join(base_dir, rel_path)):
+                with open(os.path.join(base_dir, rel_path), 'rb') as fp:
+                    for block in iter(lambda: fp.read(1024 * 1024), b''):
+                        digest.update(block)
+
+        for path in paths:
+            if not os.path.exists(os.path.join(base_dir, path)):
+                continue
+            addEntry(path)
+            for root, dirs, files in os.walk(os.path.join(base_dir, path)):
+                dirs.sort()
+                rel_root = os.path.relpath(root, base_dir)
+                for name in dirs + sorted(files):
+                    addEntry(os.path.join(rel_root, name))
+        return digest.hexdigest()
+
+    def summary(self):
+        return "Archive cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    @contextlib.contextmanager
+    def archive(self, base_dir, paths, make_archive, compression):
+        """
+        Context manager giving the path of the cached archive of paths made
+        with compression, on a miss make_archive(tar_path) is called to create
+        it.
+        """
+        key = self.key(base_dir, paths, str(compression))
+        tar_path = os.path.abspath(
+            self.cache_dir + '/' + key + compression.suffix())
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+            self.in_use[tar_path] = self.in_use.get(tar_path, 0) + 1
+        try:
+            with key_lock:
+                if os.path.isfile(tar_path):
+                    print("Reusing cached archive " + tar_path)
+                    self.hits += 1
+                    os.utime(tar_path)
+                else:
+                    print("Creating compressesd file " + tar_path)
+                    self.misses += 1
+                    tmp_path = tar_path + '.' + str(threading.get_ident()) + '.tmp'
+                    try:
+                        make_archive(tmp_path)
+                        os.replace(tmp_path, tar_path)
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+            self.__evict__()
+            yield tar_path
+        finally:
+            with self.lock:
+                self.in_use[tar_path] -= 1
+
+    def __evict__(self):
+        with self.lock:
+            archives = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.abspath(self.cache_dir + '/' + name)
+                if name.endswith('.tar') or name.endswith('.tar.gz'):
+                    stat = os.stat(path)
+                    archives.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for (_, size, _) in archives)
+            for (_, size, path) in sorted(archives):
+                if total <= self.max_bytes:
+                    break
+                if self.in_use.get(path, 0) == 0:
+                    print("Evicting cached archive " + path)
+                    os.remove(path)
+                    total -= size
+
+
+class ArchivePipe:
+
+    """
+    Readable archive stream of paths relative to base_dir. The archive is
+    compressed on a producer thread while it is being read, with at most
+    max_chunks chunks of chunk_size bytes buffered in between. Memory use stays
+    constant whatever the size of the sources.
+    """
+
+    class Writer:
+
+        def __init__(self, pipe):
+            self.pipe = pipe
+            self.pending = bytearray()
+
+        def write(self, data):
+            self.pending += data
+            if len(self.pending) >= self.pipe.chunk_size:
+                self.flush()
+            return len(data)
+
+        def flush(self):
+            if self.pending:
+                self.pipe.__put__(bytes(self.pending))
+                self.pending = bytearray()
+
+    def __init__(self, base_dir, paths, compression, chunk_size=1024 * 1024, max_chunks=8):
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.done = False
+        self.closed = False
+        self.producer = threading.Thread(
+            target=self.__produce__, args=(base_dir, paths), daemon=True)
+        self.producer.start()
+
+    def __put__(self, item):
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise BrokenPipeError("archive pipe closed by the reader")
+
+    def __produce__(self, base_dir, paths):
+        try:
+            writer = ArchivePipe.Writer(self)
+            self.compression.archive(writer, base_dir, paths)
+            writer.flush()
+            self.__put__(None)
+        except BrokenPipeError:
+            pass
+        except Exception as err:
+            try:
+                self.__put__(err)
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk == None:
+                self.done = True
+            elif isinstance(chunk, Exception):
+                self.done = True
+                raise RuntimeError("Could not archive the sources") from chunk
+            else:
+                self.buffer += chunk
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer = bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.closed = True
+        self.producer.join()
+
+
+class MultipartStream:
+
+    """
+    multipart/form-data request body made of text fields and a single file.
+    The body is read in chunks, so the file is streamed and never held in
+    memory. When the size of the file is known the body is sent with a
+    Content-Length, otherwise it is sent with a chunked transfer encoding.
+    """
+
+    def __init__(self, fields, file_field, file_name, file_obj, file_size=None, progress=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        head = ''.join(
+            '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' %
+            (self.boundary, key, value) for (key, value) in fields)
+        head += '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+            'Content-Type: application/octet-stream\r\n\r\n' % (
+                self.boundary, file_field, file_name)
+        tail = '\r\n--%s--\r\n' % self.boundary
+        self.parts = [io.BytesIO(head.encode()), file_obj,
+                      io.BytesIO(tail.encode())]
+        self.length = None
+        if file_size != None:
+            self.length = len(head.encode()) + file_size + len(tail.encode())
+        self.sent = 0
+        self.progress = progress
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.pop(0).close()
+            data += chunk
+        self.sent += len(data)
+        if self.progress != None and data:
+            self.progress(self.sent, self.length)
+        return data
+
+    def chunks(self, chunk_size=1024 * 1024):
+        """
+        Generator over the body, used when its length is unknown
+        """
+        chunk = self.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(chunk_size)
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+        self.parts = []
+
+
+class SubmissionUploader:
+
+    """
+    Uploads submissions to the buildWithParameters end point of jobs over a
+    pooled http session. The archive is streamed, every parameter is sent as
+    a form field, and failed uploads are retried with an exponential backoff
+    as long as they cannot have queued a build already (see upload).
+    """
+
+    # answers of a proxy in front of jenkins, the build may or may not be queued
+    RETRY_STATUS = [502, 503, 504]
+
+    def __init__(self, user, token, pool_size=4, retries=3, backoff=2.0, timeout=60):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user, token)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __progress__(self, start):
+        last_report = [start]
+
+        def report(sent, length):
+            now = time.monotonic()
+            if now - last_report[0] >= 1.0 or sent == length:
+                last_report[0] = now
+                rate = sent / max(now - start, 1e-6) / 1e6
+                if length == None:
+                    sys.stdout.write("\r%.2f MB sent, %.2f MB/s" %
+                                     (sent / 1e6, rate))
+                else:
+                    done = int(50 * sent / length)
+                    sys.stdout.write("\r[%s%s] %.2f MB/s" % (
+                        '=' * done, ' ' * (50 - done), rate))
+                sys.stdout.flush()
+        return report
+
+    def upload(self, url, fields, file_field, file_path=None, open_stream=None, file_name=None,
+               queued=None):
+        """
+        POST fields and a file to url, returns the response of the server or
+        raises once all the retries failed. The file is either read from
+        file_path or from a fresh stream returned by open_stream() on every
+        attempt.
+
+        A POST that queues a build must not be sent twice. It is retried
+        right away when it cannot have reached the server, i.e., the
+        connection could not be made or broke before the whole body was
+        sent. After a timeout waiting for the answer, a connection lost once
+        the body was sent, or a 502, 503 or 504, the build may be queued
+        already. It is then only retried if queued() says that no build was
+        queued, and never without queued. Returns None when queued() found
+        the build queued. Other server errors are raised without retrying.
+        """
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            if open_stream != None:
+                body = MultipartStream(fields, file_field, file_name, open_stream(),
+                                       progress=self.__progress__(start))
+            else:
+                body = MultipartStream(fields, file_field,
+                                       os.path.basename(file_path), open(file_path, 'rb'),
+                                       os.path.getsize(file_path), self.__progress__(start))
+            # whether the server may have received the whole request
+            delivered = True
+            try:
+                response = self.session.post(url, timeout=self.timeout,
+                                             data=body if body.length != None else body.chunks(),
+                                             headers={'Content-Type': body.content_type})
+                error = None if not response.status_code in SubmissionUploader.RETRY_STATUS else \
+                    "server returned %d" % response.status_code
+            except requests.ConnectTimeout as err:
+                error = str(err)
+                delivered = False
+            except requests.Timeout as err:
+                error = str(err)
+            except requests.ConnectionError as err:
+                error = str(err)
+                delivered = len(body.parts) == 0
+            finally:
+                body.close()
+            if error == None:
+                break
+            if delivered:
+                if queued == None:
+                    raise RuntimeError("Upload to %s failed: %s, a build may be queued already" % (
+                        url, error))
+                if queued():
+                    print("\nUpload to %s got no answer (%s) but the build is queued" % (url, error))
+                    return None
+            if attempt < self.retries:
+                wait = self.backoff ** attempt
+                print("\nUpload failed (%s), retrying in %.0f s" % (error, wait))
+                time.sleep(wait)
+        else:
+            raise RuntimeError("Upload to %s failed: %s" % (url, error))
+        response.raise_for_status()
+        elapsed = time.monotonic() - start
+        print("\nUploaded %.2f MB in %.1f s (%.2f MB/s)" % (
+            body.sent / 1e6, elapsed, body.sent / max(elapsed, 1e-6) / 1e6))
+        return response
+
+
+class JobSnapshot:
+
+    """
+    State of every job in a folder (the user folder), fetched with a single
+    request using the tree filter of the json api. Operations of JenkinsJob
+    resolve against the snapshot in JenkinsJob.snapshot, if any, instead of
+    querying the server about each job. The last build of a job carries the
+    same fields as the ones returned by get_build_info that the operations use.
+    """
+
+    TREE = 'jobs[name,url,inQueue,lastBuild[number,url,building,result,timestamp,' \
+        'duration,estimatedDuration,artifacts[fileName,relativePath]]]'
+
+    def __init__(self, server, folder):
+        self.folder = folder
+        try:
+            info = server.get_info(item='job/' + folder,
+                                   query='?tree=' + JobSnapshot.TREE)
+            jobs = info.get('jobs', [])
+        except jenkins.NotFoundException:
+            jobs = []
+        self.jobs = dict((job['name'], job) for job in jobs)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def exists(self, name):
+        return name in self.jobs
+
+    def job(self, name):
+        return self.jobs.get(name)
+
+    def lastBuild(self, name):
+        job = self.jobs.get(name)
+        return job['lastBuild'] if job != None else None
+
+    def created(self, name):
+        self.jobs[name] = {'name': name, 'url': None, 'lastBuild': None}
+
+    def deleted(self, name):
+        self.jobs.pop(name, None)
+
+
+class ConsoleTail:
+
+    """
+    Incremental reader of build console logs through logText/progressiveText.
+    The offset reached in every build is remembered, and kept in state_path
+    between invocations when one is given, so each fetch only transfers output
+    that was not seen before. Offsets of finished builds are dropped from the
+    state, their final offset is kept in memory so that fetching them again
+    transfers nothing.
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self.offsets = {}
+        self.finished = {}
+        self.lock = threading.Lock()
+        if state_path != None and os.path.isfile(state_path):
+            with open(state_path, 'r') as state_fp:
+                self.offsets = json.load(state_fp)
+
+    def fetch(self, server, build_url):
+        """
+        Return the output of the build at build_url that was not fetched yet,
+        and whether more output is expected (i.e., the build is running)
+        """
+        with self.lock:
+            if build_url in self.finished:
+                return ('', False)
+            offset = self.offsets.get(build_url, 0)
+        response = server.jenkins_request(requests.Request(
+            'GET', build_url + 'logText/progressiveText', params={'start': offset}))
+        more = response.headers.get('X-More-Data') == 'true'
+        size = int(response.headers.get('X-Text-Size', offset))
+        with self.lock:
+            if more:
+                self.offsets[build_url] = size
+            else:
+                self.offsets.pop(build_url, None)
+                self.finished[build_url] = size
+            self.__save__()
+        return (response.text, more)
+
+    def follow(self, server, build_url, interval=2):
+        """
+        Print the new output of the build as it arrives, until it finishes
+        """
+        while True:
+            (text, more) = self.fetch(server, build_url)
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            if not more:
+                break
+            time.sleep(interval)
+
+    def __save__(self):
+        if self.state_path != None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+            with open(self.state_path + '.tmp', 'w') as state_fp:
+                json.dump(self.offsets, state_fp)
+            os.replace(self.state_path + '.tmp', self.state_path)
+
+
+class DownloadManager:
+
+    """
+    Downloads files over a pooled http session. A transfer is written to a
+    .part file and only renamed into place once its size matches the length
+    announced by the server, so an interrupted transfer never looks complete.
+    Retries resume a .part file of the same url with a Range request made
+    conditional on the validator of the file (If-Range), or restart it when
+    the file changed or the server does not honor ranges. Reads start at min_chunk bytes and grow or
+    shrink so that each read takes about target seconds. fetchAll runs up to
+    workers transfers concurrently.
+    """
+
+    def __init__(self, user, token, workers=4, retries=3, timeout=60,
+                 min_chunk=64 * 1024, max_chunk=8 * 1024 * 1024, target=0.25):
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target = target
+        self.session = requests.Session()
+        self.session.auth = (user, token)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __copy__(self, response, fp, digest, done, total, progress):
+        chunk = self.min_chunk
+        while True:
+            start = time.monotonic()
+            data = response.raw.read(chunk)
+            if not data:
+                break
+            fp.write(data)
+            digest.update(data)
+            done += len(data)
+            elapsed = time.monotonic() - start
+            if elapsed < self.target / 2:
+                chunk = min(chunk * 2, self.max_chunk)
+            elif elapsed > self.target * 2:
+                chunk = max(chunk // 2, self.min_chunk)
+            if progress and total != None:
+                bar = int(50 * done / max(total, 1))
+                sys.stdout.write("\r[%s%s]" % ('=' * bar, ' ' * (50 - bar)))
+                sys.stdout.flush()
+        if progress and total != None:
+            sys.stdout.write("\n")
+
+    def __load_part__(self, url, part_path):
+        """
+        Offset and validator (ETag or Last-Modified) to resume part_path
+        with. A .part file left by a transfer of another url, or whose
+        validator is unknown, is discarded and the transfer starts over.
+        """
+        state = None
+        if os.path.isfile(part_path + '.json'):
+            try:
+                with open(part_path + '.json', 'r') as state_fp:
+                    state = json.load(state_fp)
+            except ValueError:
+                state = None
+        if os.path.isfile(part_path) and state != None and \
+                state.get('url') == url and state.get('validator') != None:
+            return (os.path.getsize(part_path), state['validator'])
+        DownloadManager.__discard_part__(part_path)
+        return (0, None)
+
+    def __save_part__(url, part_path, response):
+        """
+        Record the url and the validator of the transfer being written to
+        part_path, weak ETags cannot be used in If-Range
+        """
+        validator = response.headers.get('etag')
+        if validator == None or validator.startswith('W/'):
+            validator = response.headers.get('last-modified')
+        with open(part_path + '.json', 'w') as state_fp:
+            json.dump({'url': url, 'validator': validator}, state_fp)
+
+    def __discard_part__(part_path):
+        for stale in [part_path, part_path + '.json']:
+            if os.path.isfile(stale):
+                os.remove(stale)
+
+    def fetch(self, url, path, progress=True):
+        """
+        Download url to path and return the size and the sha256 hex digest of
+        the downloaded file. A .part file is only resumed for the same url,
+        with an If-Range request on its validator, the server answers with the
+        whole file when it changed since. Network errors are retried, local
+        errors (e.g., disk full or permissions) are raised.
+        """
+        part_path = path + '.part'
+        attempt = 0
+        while True:
+            (offset, validator) = self.__load_part__(url, part_path)
+            headers = {'Accept-Encoding': 'identity'}
+            if offset > 0:
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = validator
+            try:
+                with self.session.get(url, headers=headers, stream=True,
+                                      timeout=self.timeout) as response:
+                    if response.status_code == 416 and offset > 0:
+                        # the .part file is not shorter than the file, start
+                        # over right away, this is not a failed attempt
+                        DownloadManager.__discard_part__(part_path)
+                        continue
+                    response.raise_for_status()
+                    digest = hashlib.sha256()
+                    content_range = response.headers.get('content-range', '')
+                    if response.status_code == 206 and \
+                            not content_range.startswith('bytes %d-' % offset):
+                        # not the range asked for, start over
+                        DownloadManager.__discard_part__(part_path)
+                        raise requests.ConnectionError(
+                            "asked for bytes %d-, got %s" % (offset, content_range))
+                    if response.status_code != 206:
+                        # a full answer, the .part file is stale
+                        offset = 0
+                        DownloadManager.__discard_part__(part_path)
+                        DownloadManager.__save_part__(url, part_path, response)
+                    elif offset > 0:
+                        print("Resuming %s at %d bytes" % (path, offset))
+                        with open(part_path, 'rb') as fp:
+                            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                                digest.update(block)
+                    length = response.headers.get('content-length')
+                    total = offset + int(length) if length != None else None
+                    with open(part_path, 'ab' if offset > 0 else 'wb') as fp:
+                        self.__copy__(response, fp, digest,
+                                      offset, total, progress)
+                size = os.path.getsize(part_path)
+                if total != None and size != total:
+                    raise requests.ConnectionError(
+                        "got %d of %d bytes" % (size, total))
+                os.replace(part_path, path)
+                DownloadManager.__discard_part__(part_path)
+                return (size, digest.hexdigest())
+            except requests.HTTPError:
+                raise
+            except (requests.RequestException, urllib3.exceptions.HTTPError) as err:
+                if attempt >= self.retries:
+                    raise RuntimeError("Could not download %s: %s" % (url, err)) from err
+                print("Download of %s interrupted (%s), retrying" % (url, err))
+                time.sleep(2 ** attempt)
+                attempt += 1
+
+    def fetchAll(self, transfers):
+        """
+        Download a list of (url, path) pairs concurrently, returns a list of
+        (path, result) pairs where result is the (size, digest) pair returned
+        by fetch, or the exception raised for failed transfers
+        """
+        def fetchOne(transfer):
+            (url, path) = transfer
+            try:
+                return (path, self.fetch(url, path, progress=False))
+            except Exception as err:
+                return (path, err)
+
+        # progress is printed from the calling thread, which may be buffering
+        # its output (see ConsoleBuffer)
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for ((url, _), (path, result)) in zip(transfers, executor.map(fetchOne, transfers)):
+                if isinstance(result, Exception):
+                    printError("Could not download %s: %s" % (url, result))
+                else:
+                    print("Downloaded %s (%.2f MB)" % (path, result[0] / 1e6))
+                results.append((path, result))
+        return results
+
+
+class Artifacts:
+
+    """
+    Read access to the artifacts of a build by their relative path, either
+    inside the artifacts.zip archive of the build (under archive/) or in the
+    directory the artifacts were selectively downloaded to. Zip members are
+    decompressed as they are read, nothing is extracted to disk.
+    """
+
+    ZIP_ROOT = 'archive/'
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isfile(path):
+            self.zip = zipfile.ZipFile(path, 'r')
+            self.names = set(self.zip.namelist())
+        else:
+            self.zip = None
+            self.names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.zip != None:
+            self.zip.close()
+            self.zip = None
+
+    def describe(self, relative_path):
+        if self.zip != None:
+            return self.path + ':' + Artifacts.ZIP_ROOT + relative_path
+        return os.path.join(self.path, relative_path)
+
+    def exists(self, relative_path):
+        """
+        Whether the artifact, or a directory of artifacts, exists
+        """
+        if self.zip == None:
+            return os.path.exists(os.path.join(self.path, relative_path))
+        name = Artifacts.ZIP_ROOT + relative_path.rstrip('/')
+        return name in self.names or \
+            any(n.startswith(name + '/') for n in self.names)
+
+    def open(self, relative_path):
+        """
+        Open an artifact as a binary stream
+        """
+        if self.zip != None:
+            return self.zip.open(Artifacts.ZIP_ROOT + relative_path, 'r')
+        return open(os.path.join(self.path, relative_path), 'rb')
+
+    def openText(self, relative_path):
+        """
+        Open an artifact as a text stream
+        """
+        return io.TextIOWrapper(self.open(relative_path), errors='replace')
+
+
+class JobsFile:
+
+    """
+    Job description file. Either a .json file holding the username, the token
+    and the list of jobs, or a .jsonl (JSON Lines) file, as written by
+    enumerate.py, whose first line holds the same description without the
+    jobs and every following line one job. The jobs of a .jsonl file are read
+    lazily, one line at a time, so that large job spaces are never loaded
+    into memory at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.streamed = path.endswith('.jsonl')
+        with open(path, 'r') as fp:
+            if self.streamed:
+                self.desc = json.loads(fp.readline())
+            else:
+                self.desc = json.load(fp)
+        # the number of jobs of a stream is not known before reading it
+        self.count = None if self.streamed else len(self.desc['jobs'])
+
+    def __getitem__(self, key):
+        return self.desc[key]
+
+    def jobs(self):
+        """
+        Generator of the job descriptions, in the file order
+        """
+        if not self.streamed:
+            for job in self.desc['jobs']:
+                yield job
+            return
+        with open(self.path, 'r') as fp:
+            fp.readline()
+            for line in fp:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+    def resolvePrompts(self, make_job, resolve):
+        """
+        Ask the prompts of all the jobs in one pass over the file, before any
+        work is dispatched. make_job(job_info) makes a job and resolve(job)
+        asks its prompts (e.g., JenkinsJob.resolvePrompts). Only the answers
+        are kept, returns a dictionary from job name to the answers of the
+        job, to be handed to the jobs made later with JenkinsJob.useAnswers.
+        """
+        answers = {}
+        for job_info in self.jobs():
+            job = make_job(job_info)
+            resolve(job)
+            if len(job.answers) > 0:
+                answers[job.name] = job.answers
+        return answers
+
+
 class JenkinsJob:
 
     """
@@ -70,11 +1012,67 @@ class JenkinsJob:
     """
     DEFAULT_SERVER = 'http://iccluster126.iccluster.epfl.ch:8080/'
     DEFAULT_TEMPLATE = 'templates/shell_build_template'
+    DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/streamblocks_jenkins')
+    MANIFEST = 'artifacts_manifest.json'
+
+    # templates are shared by all the jobs of a process
+    template_cache = TemplateCache()
+
+    # archive cache, submission archives are not cached when None
+    archive_cache = None
+
+    # uploader shared by all the jobs, a new one is made per job when None
+    uploader = None
+
+    # download manager shared by all the jobs, a new one is made per job
+    # when None
+    download_manager = None
+
+    # compress the sources while uploading them, instead of making an archive
+    # on disk first (the archive cache is not used then)
+    stream_archives = False
+
+    # snapshot of the user folder the operations resolve against, the server
+    # is queried about each job when None
+    snapshot = None
+
+    # console offsets of the query operation, and whether query follows the
+    # output of running builds until they finish
+    console = ConsoleTail()
+    follow_console = False
+
+    # how the submission archives are compressed
+    compression = Compression()
+
+    # sources in the job directory that are sent to the server
+    TAR_SOURCES = [
+        'vivado-hls',
+        'multicore',
+        'CMakeLists.txt',
+        'bin'
+    ]
+
+    # question, default answer and the answer taken when prompts are disabled
+    PROMPTS = {
+        'rebuild': ("Job %s already exists, do you want to reconfigure and rebuild?", 'yes', True),
+        'clean': ("Do you want to clean job %s?", 'no', True),
+        'console': ("Job %s is building, show console output?", 'yes', True),
+        'redownload': ("Archive already exists at %s, download again?", 'no', False),
+        'refetch': ("Artifacts already exist in %s, download again?", 'no', False)
+    }
 
     def getServer(url, username, password):
         return jenkins.Jenkins(url,
                                username=username, password=password)
 
+    def jobUrl(server_url, job_name):
+        """
+        Url of a job given its full name, e.g., user/job is found under
+        <server_url>job/user/job/job/
+        """
+        return server_url + ''.join(
+            'job/' + requests.utils.quote(part) + '/' for part in job_name.split('/'))
+
     def __init__(self, job_info, no_prompt=False):
 
         try:
@@ -87,12 +1085,69 @@ class JenkinsJob:
         except KeyError as err:
             printError("Invalid job key:")
             raise RuntimeError from err
+        self.answers = {}
 
     def jobName(self, user):
         return user + "/" + self.name
 
+    def __ask__(self, prompt, subject):
+        """
+        Ask one of the PROMPTS about subject, a question is only asked once
+        per job and the answer is reused afterwards.
+        """
+        if prompt not in self.answers:
+            question, default, unattended = JenkinsJob.PROMPTS[prompt]
+            self.answers[prompt] = unattended if self.no_prompt else queryYesNo(
+                question % subject, default)
+        return self.answers[prompt]
+
+    def resolvePrompts(self, server, user):
+        """
+        Ask every question the operation may need up front, so that the job
+        can later run unattended (e.g., on a worker thread). Questions that
+        could not be foreseen take the answer used with no_prompt.
+        """
+        if not self.no_prompt:
+            if self.operation == "build":
+                if self.jobExists(server, user):
+                    self.__ask__('rebuild', self.name)
+            elif self.operation == "clean":
+                self.__ask__('clean', self.name)
+            elif self.operation == "query":
+                build_info = self.__get_last_build_info__(server, user)
+                if build_info != None and build_info['building'] == True:
+                    self.__ask__('console', self.jobName(user))
+            elif self.operation == "download":
+                dl_dir = self.dir + '/artifacts.zip'
+                if os.path.isfile(dl_dir) and not self.__has_manifest__():
+                    self.__ask__('redownload', dl_dir)
+        self.no_prompt = True
+
+    def useAnswers(self, answers):
+        """
+        Take the answers of prompts resolved earlier (see
+        JobsFile.resolvePrompts), the job then runs unattended
+        """
+        self.answers = dict(answers)
+        self.no_prompt = True
+
+    def resolveDownloadPrompts(self, include=None):
+        """
+        Same as resolvePrompts for a download of the artifacts (with include
+        globs as in download) that is not the operation of the job, such as
+        the ones of the report scripts
+        """
+        if not self.no_prompt:
+            if include == None:
+                dl_dir = self.dir + '/artifacts.zip'
+                if os.path.isfile(dl_dir) and not self.__has_manifest__():
+                    self.__ask__('redownload', dl_dir)
+            elif os.path.isdir(self.dir + '/artifacts/') and not self.__has_manifest__():
+                self.__ask__('refetch', self.dir + '/artifacts/')
+        self.no_prompt = True
+
     """
-  Submit the job to the server
+  Submit the job to the server, returns False if the operation failed
   """
 
     def submit(self, server, user, token, template_name):
@@ -100,34 +1155,33 @@ class JenkinsJob:
         job_exists = self.jobExists(server, user)
         job_template = jenkins.EMPTY_CONFIG_XML
         try:
-            print("Pulling job template from jenkins %s" % (template_name))
-            job_template = server.get_job_config(template_name)
+            job_template = JenkinsJob.template_cache.get(server, template_name)
         except Exception as e:
             raise RuntimeError(
                 "Could not fetch job template " + template_name + ": " + str(e))
         if self.operation == "build":
             should_build = False
             if job_exists:
-                should_build = True if self.no_prompt else queryYesNo(
-                    "Job " + self.name + " already exists, do you want to reconfigure and rebuild?", 'yes')
+                should_build = self.__ask__('rebuild', self.name)
                 if should_build:
                     server.reconfig_job(job_name, job_template)
             else:
                 # template_name = 'templates/shell_build_template'
                 server.create_job(job_name, job_template)
+                if self.__snapshot__(user) != None:
+                    self.__snapshot__(user).created(self.name)
                 should_build = True
             if should_build:
                 try:
 
-                    self.__submit_build__(server, user, token)
-                except subprocess.SubprocessError as err:
-                    print("Failed to enqueue job %s\n:" %
+                    return self.__submit_build__(server, user, token)
+                except (requests.RequestException, RuntimeError) as err:
+                    print("Failed to enqueue job %s:\n%s" %
                           (self.name, err))
-                    pass
+                    return False
 
         elif self.operation == "clean":
-            prompt = True if self.no_prompt else queryYesNo(
-                "Do you want to clean job " + self.name + "?", 'no')
+            prompt = self.__ask__('clean', self.name)
             if job_exists and prompt:
                 self.__submit_clean__(server, user)
             else:
@@ -139,69 +1193,92 @@ class JenkinsJob:
             self.download(server, user, token)
         else:
             print("Invalid operation " + self.operation)
+            return False
+        return True
+
+    def __make_archive__(self, tar_path):
+        """
+        Compress the submission sources found in the job directory into
+        tar_path. The working directory is left alone, so jobs can be archived
+        from several threads at once.
+        """
+        with open(tar_path, 'wb') as tar_fp:
+            JenkinsJob.compression.archive(
+                tar_fp, self.dir, JenkinsJob.TAR_SOURCES)
+
+    @contextlib.contextmanager
+    def __archive__(self):
+        """
+        Path to the submission archive, either shared from the archive cache
+        or made for this submission only and removed afterwards.
+        """
+        if JenkinsJob.archive_cache != None:
+            with JenkinsJob.archive_cache.archive(self.dir, JenkinsJob.TAR_SOURCES,
+                                                  self.__make_archive__,
+                                                  JenkinsJob.compression) as tar_path:
+                yield tar_path
+        else:
+            tar_path = os.path.abspath(
+                self.dir + '/' + self.name + JenkinsJob.compression.suffix())
+            print("Creating compressesd file " + tar_path)
+            self.__make_archive__(tar_path)
+            try:
+                yield tar_path
+            finally:
+                print("Cleaning up temp archives")
+                os.remove(tar_path)
 
     def __submit_build__(self, server, user, token):
         job_name = self.jobName(user)
 
-        root_dir = os.getcwd()
-
-        job_url = server.get_job_info(job_name)['url']
+        snapshot = self.__snapshot__(user)
+        if snapshot != None and snapshot.job(self.name)['url'] != None:
+            job_url = snapshot.job(self.name)['url']
+        else:
+            job_url = server.get_job_info(job_name)['url']
         job_build_url = job_url + "/buildWithParameters"
 
-        def tardir(paths, tar_name):
-            with tarfile.open(tar_name, 'w:gz') as tar_handle:
-                for path in paths:
-                    if os.path.exists(path):
-                        tar_handle.add(path, recursive=True)
-
-        tarbal = self.name + '.tar.gz'
-        tar_sources = [
-            'vivado-hls',
-            'multicore',
-            'CMakeLists.txt',
-            'bin'
-        ]
-
-        print("Creating compressesd file " + tarbal)
-        os.chdir(self.dir)
-
-        tardir(tar_sources, tarbal)
-
-        forms = "--form submission_file=@" + "./" + tarbal + " "
-        forms = forms + "--form NETWORK_NAME=" + self.network + " "
-
-        for (param_key, param_value) in self.params.items():
-            if type(param_value) != str:
-                param_value = str(param_value)
-            forms = forms + "--form " + param_key + "=" + param_value + " "
-
-        # This is a very ugly way of doing things, all because I can not send
-        # a file using the python api...
+        fields = [('NETWORK_NAME', self.network)] + \
+            [(key, str(value)) for (key, value) in self.params.items()]
 
-        print("Uploading submission")
-        curl_cmd = "curl " + job_build_url + " --user " + user + ":" + token + " " + forms
+        # an upload that got no answer may have queued the build, it is not
+        # sent again if the job was queued or started a build since
+        next_build = server.get_job_info(job_name)['nextBuildNumber']
 
-        curl = subprocess.run(curl_cmd, shell=True, stdout=subprocess.PIPE)
-
-        print("Cleaning up temp archives")
-
-        os.remove(tarbal)
-        os.chdir(root_dir)
-
-        if curl.returncode != 0:
-            print("Submission failed\n%s" % (curl_cmd))
+        def queued():
+            job_info = server.get_job_info(job_name)
+            return job_info['inQueue'] or job_info['nextBuildNumber'] > next_build
+
+        uploader = JenkinsJob.uploader
+        if uploader == None:
+            uploader = SubmissionUploader(user, token)
+
+        if JenkinsJob.stream_archives:
+            print("Compressing and uploading submission")
+            uploader.upload(job_build_url, fields, 'submission_file',
+                            open_stream=lambda: ArchivePipe(
+                                self.dir, JenkinsJob.TAR_SOURCES, JenkinsJob.compression),
+                            file_name=self.name + JenkinsJob.compression.suffix(),
+                            queued=queued)
+        else:
+            with self.__archive__() as tarbal:
+                print("Uploading submission")
+                uploader.upload(job_build_url, fields,
+                                'submission_file', tarbal, queued=queued)
+        return True
 
     def __submit_clean__(self, server, user):
         job_name = self.jobName(user)
         if self.jobExists(server, user):
 
-            job_info = server.get_job_info(job_name)
-            if job_info != None:
-                last_build_number = job_info['lastBuild']['number']
+            build_info = self.__get_last_build_info__(server, user)
+            if build_info != None and build_info['building'] == True:
                 print("Stopping build for job %s" % job_name)
-                server.stop_build(job_name, last_build_number)
-                print("Cleaning job %s" % job_name)
-                server.delete_job(job_name)
+                server.stop_build(job_name, build_info['number'])
+            print("Cleaning job %s" % job_name)
+            server.delete_job(job_name)
+            if self.__snapshot__(user) != None:
+                self.__snapshot__(user).deleted(self.name)
 
     """
   Query the status of the job
@@ -213,15 +1290,17 @@ class JenkinsJob:
         build_info = self.__get_last_build_info__(server, user)
         if build_info != None:
             if build_info['building'] == True:
-                show_console = True if self.no_prompt else queryYesNo(
-                    "Job " + job_name + " is building, show console output?", 'yes')
+                show_console = self.__ask__('console', job_name)
                 if show_console:
-                    console_output = server.get_build_console_output(
-                        job_name, build_info['number'])
                     print(
                         "-------------------------------------------------------------")
                     print("JOB: %s" % job_name)
-                    print("\n\n%s\n\n" % console_output)
+                    if JenkinsJob.follow_console:
+                        JenkinsJob.console.follow(server, build_info['url'])
+                    else:
+                        (console_output, _) = JenkinsJob.console.fetch(
+                            server, build_info['url'])
+                        print("\n\n%s\n\n" % console_output)
                 print("=============================================================")
             else:
                 print("Job %s is not building" % job_name)
@@ -230,10 +1309,12 @@ class JenkinsJob:
 
     def __get_last_build_info__(self, server, user):
         job_name = self.jobName(user)
+        if self.__snapshot__(user) != None:
+            return self.__snapshot__(user).lastBuild(self.name)
         if self.jobExists(server, user):
             print("Pulling %s job info" % job_name)
             job_info = server.get_job_info(job_name)
-            if job_info != None:
+            if job_info != None and job_info['lastBuild'] != None:
                 last_build_number = job_info['lastBuild']['number']
                 build_info = server.get_build_info(job_name, last_build_number)
                 return build_info
@@ -243,169 +1324,893 @@ class JenkinsJob:
   Download the artifacts
   """
 
-    def download(self, server, user, token):
-
+    def download(self, server, user, token, include=None):
+        """
+        Download the artifacts of the last build. Either the whole archive
+        into <dir>/artifacts.zip or, given a list of include globs, only the
+        artifacts whose relative path matches one of them into
+        <dir>/artifacts/<relative path>. Artifacts the manifest of the job
+        directory records for the same build are not downloaded again.
+        """
         job_name = self.jobName(user)
         if self.jobExists(server, user):
             build_info = self.__get_last_build_info__(server, user)
             if build_info != None:
-                if build_info['building'] == False and len(build_info['artifacts']) > 0:
+                if build_info['building'] == False:
+                    self.__clear_stale_artifacts__(build_info)
+                if build_info['building'] == False and len(build_info['artifacts']) > 0 \
+                        and include != None:
+                    self.__download_artifacts__(
+                        build_info, include, user, token)
+                elif build_info['building'] == False and len(build_info['artifacts']) > 0:
                     job_url = build_info['url']
                     dl_url = job_url + 'artifact/*zip*/archive.zip'
 
-                    print("Downloading artifacts from " + dl_url)
                     dl_dir = self.dir + '/artifacts.zip'
-
+                    manifest = self.__load_manifest__(build_info)
+                    if self.__synced__(manifest, ['artifacts.zip']):
+                        print("Artifacts of build #%d are up to date in %s" % (
+                            build_info['number'], dl_dir))
+                        return
 
                     should_download = True
-                    if os.path.isfile(dl_dir):
-                        if self.no_prompt == True:
-                            should_download = False
-                        else:
-                            should_download = queryYesNo("Archive already exists at " +
-                                                     dl_dir + ", download again?", 'no')            
+                    if os.path.isfile(dl_dir) and not self.__has_manifest__():
+                        should_download = self.__ask__('redownload', dl_dir)
                     if should_download:
-                        with open(dl_dir, 'wb') as f:
-                            response = requests.get(
-                                dl_url, stream=True, auth=(user, token))
-                            total_length = response.headers.get(
-                                'content-length')
-
-                            if total_length is None:  # no content length header
-                                f.write(response.content)
-                            else:
-                                dl = 0
-                                total_length = int(total_length)
-                                for data in response.iter_content(chunk_size=4096):
-                                    dl += len(data)
-                                    f.write(data)
-                                    done = int(50 * dl / total_length)
-                                    sys.stdout.write("\r[%s%s]" % (
-                                        '=' * done, ' ' * (50-done)))
-                                    sys.stdout.flush()
+                        print("Downloading artifacts from " + dl_url)
+                        result = self.__downloads__(
+                            user, token).fetch(dl_url, dl_dir)
+                        self.__save_manifest__(
+                            build_info, [('artifacts.zip', None, result)])
                 else:
                     print("Job is not finished")
         else:
             print("Job does not exist")
 
+    def __download_artifacts__(self, build_info, include, user, token):
+        selected = [artifact['relativePath'] for artifact in build_info['artifacts']
+                    if any(fnmatch.fnmatch(artifact['relativePath'], pattern)
+                           for pattern in include)]
+        if len(selected) == 0:
+            print("No artifact matches " + " ".join(include))
+            return
+        dl_root = self.dir + '/artifacts/'
+        manifest = self.__load_manifest__(build_info)
+        if not self.__has_manifest__() and any(os.path.isfile(dl_root + path) for path in selected):
+            if not self.__ask__('refetch', dl_root):
+                return
+            # the files come from an unknown build
+            shutil.rmtree(dl_root)
+        missing = [path for path in selected
+                   if not self.__synced__(manifest, ['artifacts/' + path])]
+        if len(missing) == 0:
+            print("Artifacts of build #%d are up to date in %s" % (
+                build_info['number'], dl_root))
+            return
+        print("Downloading %d of %d artifacts from %s" % (
+            len(missing), len(build_info['artifacts']), build_info['url']))
+        transfers = []
+        for path in missing:
+            os.makedirs(os.path.dirname(dl_root + path), exist_ok=True)
+            transfers.append((build_info['url'] + 'artifact/' +
+                              requests.utils.quote(path), dl_root + path))
+        results = self.__downloads__(user, token).fetchAll(transfers)
+        self.__save_manifest__(build_info, [
+            ('artifacts/' + path, path, result) for (path, (_, result)) in zip(missing, results)
+            if not isinstance(result, Exception)])
+
+    """
+  Artifact manifest of the job directory, recording which build the local
+  artifacts come from along with their size and hash
+  """
+
+    def __has_manifest__(self):
+        """
+        Whether the artifacts in the job directory are tracked by a manifest,
+        files found without one come from an unknown build
+        """
+        return os.path.isfile(self.dir + '/' + JenkinsJob.MANIFEST)
+
+    def __load_manifest__(self, build_info):
+        """
+        The manifest of the job directory if it records build_info, None
+        otherwise
+        """
+        manifest_path = self.dir + '/' + JenkinsJob.MANIFEST
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path, 'r') as manifest_fp:
+            manifest = json.load(manifest_fp)
+        if manifest['job'] != self.name or manifest['build'] != build_info['number']:
+            return None
+        return manifest
+
+    def __synced__(self, manifest, paths):
+        """
+        Whether all paths, relative to the job directory, are recorded in
+        manifest and still have the recorded size
+        """
+        if manifest == None:
+            return False
+        for path in paths:
+            entry = manifest['artifacts'].get(path)
+            if entry == None or not os.path.isfile(self.dir + '/' + path) or \
+                    os.path.getsize(self.dir + '/' + path) != entry['size']:
+                return False
+        return True
+
+    def __clear_stale_artifacts__(self, build_info):
+        """
+        Remove the artifacts the manifest records for an older build, so that
+        reports never read them as artifacts of build_info (e.g., an artifact
+        the new build does not have), and start the manifest of build_info.
+        Artifacts without a manifest are left to the prompts of download.
+        """
+        if not self.__has_manifest__() or self.__load_manifest__(build_info) != None:
+            return
+        print("Removing the artifacts of the previous build of %s" % self.name)
+        if os.path.isdir(self.dir + '/artifacts'):
+            shutil.rmtree(self.dir + '/artifacts')
+        if os.path.isfile(self.dir + '/artifacts.zip'):
+            os.remove(self.dir + '/artifacts.zip')
+        self.__save_manifest__(build_info, [])
+
+    def __save_manifest__(self, build_info, downloads):
+        """
+        Record downloads, a list of (local path, relative artifact path,
+        (size, sha256)) tuples, in the manifest of build_info. The manifest
+        also lists all the artifacts of the build, downloaded or not.
+        """
+        manifest = self.__load_manifest__(build_info)
+        if manifest == None:
+            manifest = {
+                'job': self.name,
+                'build': build_info['number'],
+                'url': build_info['url'],
+                'buildArtifacts': [artifact['relativePath'] for artifact in build_info['artifacts']],
+                'artifacts': {}
+            }
+        for (path, relative_path, (size, digest)) in downloads:
+            manifest['artifacts'][path] = {
+                'relativePath': relative_path,
+                'size': size,
+                'sha256': digest
+            }
+        manifest_path = self.dir + '/' + JenkinsJob.MANIFEST
+        with open(manifest_path + '.tmp', 'w') as manifest_fp:
+            json.dump(manifest, manifest_fp, indent=4)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def __downloads__(self, user, token):
+        """
+        The shared download manager, or one for this job only if there is none
+        """
+        if JenkinsJob.download_manager != None:
+            return JenkinsJob.download_manager
+        return DownloadManager(user, token)
+
     """
   Check if the job exits
   """
 
     def jobExists(self, server, user):
         job_name = self.jobName(user)
+        if self.__snapshot__(user) != None:
+            return self.__snapshot__(user).exists(self.name)
         return server.job_exists(job_name)
 
+    def __snapshot__(self, user):
+        """
+        The snapshot of the user folder, or None if there is none
+        """
+        snapshot = JenkinsJob.snapshot
+        if snapshot != None and snapshot.folder == user:
+            return snapshot
+        return None
+
 
-class Utilities:
+class ConsoleBuffer(io.TextIOBase):
 
-    def forceMakeDirectory(path):
+    """
+    Stand-in for sys.stdout that keeps what each worker thread prints in a
+    buffer of its own. Writes from threads that did not begin a buffer go
+    straight to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.buffer = io.StringIO()
+
+    def end(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return text
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class SubmissionPool:
+
+    """
+    Runs the operations of a list of jobs on a bounded pool of worker threads.
+    All the prompts are resolved before any work is dispatched, and the output
+    of every job is printed as a single block in the order of the jobs. Every
+    worker thread talks to the server through its own connection, created by
+    server_factory.
+    """
+
+    def __init__(self, server_factory, user, token, template_name, workers=4):
+        self.server_factory = server_factory
+        self.user = user
+        self.token = token
+        self.template_name = template_name
+        self.workers = workers
+        self.local = threading.local()
+
+    def __server__(self):
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = self.server_factory()
+            self.local.server = server
+        return server
+
+    def __run_job__(self, console, job):
+        console.begin()
+        result = {'name': job.name, 'operation': job.operation,
+                  'success': False, 'error': None}
+        try:
+            result['success'] = job.submit(
+                self.__server__(), self.user, self.token, self.template_name)
+        except Exception as err:
+            result['error'] = str(err)
+            printError("Job %s failed: %s" % (job.name, err))
+        result['output'] = console.end()
+        return result
+
+    def run(self, jobs):
         """
-        Recursively creates fresh directories given by the path. If a directory
-        tree already exits at the path, it will be removed.
+        Run all the jobs and return a list of results (one dictionary per job
+        with name, operation, success, error and output) in the job order.
         """
-        if os.path.exists(path):
-            shutil.rmtree(path)
-        os.makedirs(path)
+        jobs = list(jobs)
+        server = self.__server__()
+        for job in jobs:
+            job.resolvePrompts(server, self.user)
+
+        results = [None] * len(jobs)
+        printed = 0
+        console = ConsoleBuffer(sys.stdout)
+        sys.stdout = console
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.__run_job__, console, job): index
+                           for index, job in enumerate(jobs)}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+                    while printed < len(jobs) and results[printed] != None:
+                        console.stream.write(results[printed]['output'])
+                        console.stream.flush()
+                        printed += 1
+        finally:
+            sys.stdout = console.stream
+        return results
+
+
+class JsonListWriter:
+
+    """
+    Writes a json list to path one item at a time, formatted as json.dumps
+    with indent=4 would. Every item is flushed as soon as it is appended, and
+    the file is a complete list once closed.
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, 'w')
+        self.count = 0
+        self.fp.write('[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, item):
+        text = json.dumps(item, indent=4).replace('\n', '\n    ')
+        self.fp.write((',\n    ' if self.count > 0 else '\n    ') + text)
+        self.fp.flush()
+        self.count += 1
+
+    def close(self):
+        if self.fp != None:
+            self.fp.write('\n]' if self.count > 0 else ']')
+            self.fp.close()
+            self.fp = None
+
+
+class ReportAggregator:
+
+    """
+    Builds the reports of a list of jobs as a pipeline. The artifacts of the
+    jobs are downloaded on a pool of threads, and the report of every job is
+    parsed on a pool of processes as soon as its download is done. Jobs are
+    handed back in the order they finish, with the output of each stage
+    printed as a single block. A job that fails at any stage is handed back
+    with its error instead of stopping the others. Every download thread talks
+    to the server through its own connection, created by server_factory.
+    """
+
+    def __init__(self, server_factory, user, download_workers=4, parse_workers=None):
+        self.server_factory = server_factory
+        self.user = user
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers if parse_workers != None else (os.cpu_count() or 1)
+        self.local = threading.local()
+        self.finished = 0
+
+    def __server__(self):
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = self.server_factory()
+            self.local.server = server
+        return server
+
+    def __fetch_job__(self, console, fetch, job):
+        console.begin()
+        fetched = None
+        error = None
+        try:
+            fetched = fetch(job, self.__server__())
+            if fetched == None:
+                error = "no artifacts to report on"
+        except Exception as err:
+            error = str(err)
+        if error != None:
+            printError("Job %s failed: %s" % (job.name, error))
+        return (fetched, console.end(), error)
+
+    def __parse_job__(parse, fetched):
+        """
+        Runs on a worker process, the output is returned rather than printed
+        so that it does not interleave with the output of other jobs
+        """
+        output = io.StringIO()
+        summary = None
+        error = None
+        with contextlib.redirect_stdout(output):
+            try:
+                summary = parse(fetched)
+            except Exception as err:
+                error = "%s: %s" % (type(err).__name__, err)
+        return (summary, output.getvalue(), error)
+
+    def run(self, jobs, fetch, parse, done):
+        """
+        fetch(job, server) downloads the artifacts of a job on a worker thread
+        and returns what parse needs, parse(fetched) runs on a worker process
+        and returns the report (it must be picklable, e.g., a function of a
+        class or a functools.partial of one). done(job, report, error) is
+        called from the calling thread as every job finishes. Returns the
+        number of failed jobs.
+
+        jobs may be any iterable, e.g., a generator streaming a jobs file. It
+        is consumed lazily from the calling thread, with at most twice as many
+        jobs in flight as there are workers, so that only the jobs being
+        reported on are held in memory.
+        """
+        jobs = iter(jobs)
+        in_flight = 2 * (self.download_workers + self.parse_workers)
+        failed = 0
+        self.finished = 0
+        console = ConsoleBuffer(sys.stdout)
+        sys.stdout = console
+        try:
+            with ThreadPoolExecutor(max_workers=self.download_workers) as downloads, \
+                    ProcessPoolExecutor(max_workers=self.parse_workers) as parsers:
+                pending = {}
+
+                def submitJobs():
+                    while len(pending) < in_flight:
+                        job = next(jobs, None)
+                        if job == None:
+                            return
+                        pending[downloads.submit(self.__fetch_job__, console, fetch, job)] = (job, 'fetch')
+
+                submitJobs()
+                while pending:
+                    (finished, _) = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        (job, stage) = pending.pop(future)
+                        try:
+                            (result, output, error) = future.result()
+                        except Exception as err:
+                            (result, output, error) = (None, '', str(err))
+                        console.stream.write(output)
+                        console.stream.flush()
+                        if stage == 'parse' and error != None:
+                            printError("Job %s failed: %s" % (job.name, error))
+                        if stage == 'fetch' and error == None:
+                            pending[parsers.submit(ReportAggregator.__parse_job__, parse, result)] = \
+                                (job, 'parse')
+                            continue
+                        if error != None:
+                            failed += 1
+                        self.finished += 1
+                        done(job, result, error)
+                    submitJobs()
+        finally:
+            sys.stdout = console.stream
+        return failed
+
+
+class StatusDashboard:
 
-    def __get_utilization_report__(utilization_report_path):
+    """
+    Live status table of a list of jobs, refreshed in place. The state of all
+    the jobs comes from one JobSnapshot per refresh, and the stage of every
+    running build is parsed from the info markers jenkins.sh prints. Console
+    logs are polled concurrently with a ConsoleTail, so only new output is
+    transferred. Jobs whose log did not
+    change are polled less and less often, up to max_interval seconds apart.
+    The snapshot has its own deadline, it is polled less often too while the
+    states of the jobs do not change. With a state_path, the log offsets and
+    the stages reached are kept between invocations, so a new --watch does
+    not transfer the logs of running builds from the start again.
+    """
+
+    STAGES = [
+        'submission received.',
+        'Submission extracted',
+        'Configuring the build',
+        'Making XO',
+        'Making xclbin',
+        'XCLBIN build done!',
+        'Bulding systemc co-simulation binary',
+        'Executing simulation'
+    ]
+
+    ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+    def __init__(self, server, user, jobs, min_interval=5, max_interval=60, concurrency=8,
+                 state_path=None):
+        self.server = server
+        self.user = user
+        self.jobs = jobs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        self.state_path = state_path
+        self.snapshot = None
+        self.tail = ConsoleTail()
+        # per job name: build number, partial line, stage, polling interval
+        # and the time of the next poll
+        self.logs = {}
+        if state_path != None and os.path.isfile(state_path):
+            with open(state_path, 'r') as state_fp:
+                state = json.load(state_fp)
+            self.tail.offsets = state['offsets']
+            for (name, log) in state['logs'].items():
+                self.logs[name] = dict(log, interval=min_interval, next=0)
+
+    def __save__(self, building):
         """
-        extract synthesis utilizatino report and return it in a dictionary
+        Keep the log offsets of the running builds along with the stages
+        parsed up to them
+        """
+        if self.state_path == None:
+            return
+        logs = dict((job.name, {'build': self.logs[job.name]['build'],
+                                'partial': self.logs[job.name]['partial'],
+                                'stage': self.logs[job.name]['stage']})
+                    for (job, _) in building)
+        with self.tail.lock:
+            offsets = dict((build['url'], self.tail.offsets[build['url']])
+                           for (_, build) in building if build['url'] in self.tail.offsets)
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        with open(self.state_path + '.tmp', 'w') as state_fp:
+            json.dump({'offsets': offsets, 'logs': logs}, state_fp)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def __state__(self, job):
+        entry = self.snapshot.job(job.name)
+        if entry == None:
+            return 'MISSING'
+        if entry.get('inQueue'):
+            return 'QUEUED'
+        build = entry['lastBuild']
+        if build == None:
+            return 'NOT BUILT'
+        if build['building']:
+            return 'BUILDING'
+        return build['result'] if build['result'] != None else 'UNKNOWN'
+
+    async def __update_log__(self, semaphore, job, build):
+        log = self.logs.get(job.name)
+        if log == None or log['build'] != build['number']:
+            log = {'build': build['number'], 'partial': '', 'stage': '',
+                   'interval': self.min_interval, 'next': 0}
+            self.logs[job.name] = log
+        if log['next'] > time.monotonic():
+            return
+        more = True
+        async with semaphore:
+            try:
+                (text, more) = await asyncio.to_thread(
+                    self.tail.fetch, self.server, build['url'])
+            except Exception as err:
+                text = ''
+                log['stage'] = 'error: %s' % err
+        lines = (log['partial'] + text).split('\n')
+        log['partial'] = lines.pop()
+        for line in lines:
+            line = StatusDashboard.ANSI_ESCAPE.sub('', line).strip()
+            if line in StatusDashboard.STAGES:
+                log['stage'] = line
+        if not more:
+            # the build finished since the last snapshot, its log is complete
+            log['next'] = float('inf')
+            return
+        if text:
+            log['interval'] = self.min_interval
+        else:
+            log['interval'] = min(log['interval'] * 2, self.max_interval)
+        log['next'] = time.monotonic() + log['interval']
+
+    def __format_time__(seconds):
+        if seconds == None:
+            return '-'
+        seconds = int(max(seconds, 0))
+        return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def __render__(self):
+        now = time.time()
+        rows = []
+        for job in self.jobs:
+            state = self.__state__(job)
+            entry = self.snapshot.job(job.name)
+            build = entry['lastBuild'] if entry != None else None
+            elapsed = None
+            eta = None
+            stage = ''
+            if build != None:
+                if build['building']:
+                    elapsed = now - build['timestamp'] / 1000.
+                    if build['estimatedDuration'] > 0:
+                        eta = build['estimatedDuration'] / 1000. - elapsed
+                    if job.name in self.logs:
+                        stage = self.logs[job.name]['stage']
+                else:
+                    elapsed = build['duration'] / 1000.
+            rows.append((job.name, state, StatusDashboard.__format_time__(elapsed),
+                         stage, StatusDashboard.__format_time__(eta)))
+        width = max([len('JOB')] + [len(r[0]) for r in rows])
+        table = ["%-*s  %-9s  %9s  %-36s  %9s" %
+                 (width, 'JOB', 'STATE', 'ELAPSED', 'STAGE', 'ETA')]
+        table += ["%-*s  %-9s  %9s  %-36s  %9s" % ((width,) + r) for r in rows]
+        if sys.stdout.isatty():
+            sys.stdout.write('\033[H\033[J')
+        print("\n".join(table))
+        print("Updated %s" % time.strftime('%H:%M:%S'))
+        sys.stdout.flush()
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        interval = self.min_interval
+        previous = None
+        next_snapshot = 0
+        while True:
+            # log polls that are due may wake the loop up before the snapshot
+            # is, the states are then those of the last snapshot
+            if time.monotonic() >= next_snapshot:
+                self.snapshot = await asyncio.to_thread(JobSnapshot, self.server, self.user)
+                states = [self.__state__(job) for job in self.jobs]
+                if not any(state in ['BUILDING', 'QUEUED'] for state in states):
+                    self.__save__([])
+                    self.__render__()
+                    break
+                interval = self.min_interval if states != previous else \
+                    min(interval * 2, self.max_interval)
+                previous = states
+                next_snapshot = time.monotonic() + interval
+            building = [(job, self.snapshot.lastBuild(job.name))
+                        for (job, state) in zip(self.jobs, states) if state == 'BUILDING']
+            await asyncio.gather(*[self.__update_log__(semaphore, job, build)
+                                   for (job, build) in building])
+            self.__save__(building)
+            self.__render__()
+            next_log = min([self.logs[job.name]['next'] for (job, _) in building] +
+                           [next_snapshot])
+            await asyncio.sleep(max(next_log - time.monotonic(), 1))
+
+    def watch(self):
         """
-        if os.path.exists(utilization_report_path):
+        Refresh the table until none of the jobs is queued or building
+        """
+        asyncio.run(self.run())
 
-            def getUtil(report_dir):
-                def getUtilRE(resource):
 
-                    return re.compile(r'\|\s*' + resource + r'\s*\|\s*(\d*)(\.\d*)?\s*\|\s*\d*\s*\|\s*(\d*)\s*\|\s*(\d*\.\d*)\s*\|')
+class UtilizationReport:
 
-                def matchRE(expr, line):
-                    matches = expr.match(line)
-                    if (matches != None):
+    """
+    One pass parser of Vivado utilization reports (report_utilization). Only
+    lines starting with | are looked at, and only rows whose site type is in
+    ROWS are split into cells, so most of the report is skipped after a one
+    character test. The first row of each resource in the utilization tables
+    is kept, and with slr the per-SLR table is read as well. Reading stops as
+    soon as there is nothing left to find.
+    """
 
-                        used = int(matches.group(1))
-                        avail = int(matches.group(3))
-                        util = float(matches.group(4))
-                        return {"used": used, "availble": avail, "util": util}
-                    else:
-                        return None
-
-                report_fields = {
-                    'LUTS': {
-                        'keyword': 'CLB LUTs\*'
-                    },
-                    'FF': {
-                        'keyword': 'CLB Registers'
-                    },
-                    'BRAM': {
-                        'keyword': 'Block RAM Tile'
-                    },
-                    'DSP': {
-                        'keyword': 'DSPs'
+    ROWS = {
+        'CLB LUTs': 'LUTS',
+        'Slice LUTs': 'LUTS',
+        'CLB Registers': 'FF',
+        'Slice Registers': 'FF',
+        'Block RAM Tile': 'BRAM',
+        'DSPs': 'DSP',
+        'URAM': 'URAM',
+        'LUT as Shift Register': 'SRL',
+        'CARRY8': 'CARRY8'
+    }
+    RESOURCES = ['LUTS', 'FF', 'BRAM', 'DSP', 'URAM', 'SRL', 'CARRY8']
+    SLR_COLUMN = re.compile(r'(SLR\d+)( %)?$')
+
+    def __init__(self, fp, slr=False):
+        self.fp = fp
+        self.slr = slr
+
+    def __number__(cell, cast):
+        try:
+            return cast(cell)
+        except ValueError:
+            try:
+                return cast(float(cell))
+            except ValueError:
+                return None
+
+    def __slr_columns__(columns):
+        """
+        Map the SLR names of a per-SLR table header to the index of their used
+        and utilization columns, or None for any other table
+        """
+        slrs = {}
+        for (index, column) in enumerate(columns):
+            matches = UtilizationReport.SLR_COLUMN.match(column)
+            if matches:
+                slrs.setdefault(matches.group(1), [None, None])[
+                    1 if matches.group(2) else 0] = index
+        return slrs if slrs else None
+
+    def parse(self):
+        """
+        Return a dictionary of the RESOURCES, each one either None or a
+        dictionary with the used, availble and util (%) values, plus SLR with
+        the same dictionaries for every SLR when slr is set
+        """
+        util_sum = dict((r, None) for r in UtilizationReport.RESOURCES)
+        slr_sum = None
+        pending = len(UtilizationReport.RESOURCES)
+        columns = None
+        slr_columns = None
+        in_slr_table = False
+        slr_done = not self.slr
+
+        for line in self.fp:
+            if line[:1] != '|':
+                if in_slr_table and line[:1] == '+':
+                    in_slr_table = False
+                    slr_done = True
+                    if pending == 0:
+                        break
+                continue
+            name = line[1:line.find('|', 1)].strip().rstrip('*')
+            if name == 'Site Type':
+                columns = [c.strip() for c in line.strip().strip('|').split('|')]
+                slr_columns = UtilizationReport.__slr_columns__(columns) \
+                    if self.slr else None
+                continue
+            key = UtilizationReport.ROWS.get(name)
+            if key == None or columns == None:
+                continue
+            cells = [c.strip() for c in line.strip().strip('|').split('|')]
+
+            if slr_columns != None:
+                in_slr_table = True
+                if slr_sum == None:
+                    slr_sum = dict((slr, {}) for slr in slr_columns)
+                for (slr, (used, util)) in slr_columns.items():
+                    if key in slr_sum[slr] or used == None or used >= len(cells):
+                        continue
+                    slr_sum[slr][key] = {
+                        'used': UtilizationReport.__number__(cells[used], int),
+                        'availble': None,
+                        'util': UtilizationReport.__number__(cells[util], float)
+                        if util != None and util < len(cells) else None
                     }
+            elif util_sum[key] == None and 'Available' in columns and len(cells) == len(columns):
+                row = dict(zip(columns, cells))
+                util_sum[key] = {
+                    'used': UtilizationReport.__number__(row['Used'], int),
+                    'availble': UtilizationReport.__number__(row['Available'], int),
+                    'util': UtilizationReport.__number__(row.get('Util%', ''), float)
                 }
-                util_sum = dict(zip(report_fields.keys(), [
-                    None for v in report_fields.values()]))
+                pending -= 1
+                if pending == 0 and slr_done:
+                    break
 
-                with open(utilization_report_path) as util_fp:
-                    report = util_fp.readlines()
-                    expression_map = dict(zip(report_fields.keys(), [getUtilRE(
-                        v['keyword']) for v in report_fields.values()]))
+        if self.slr:
+            util_sum['SLR'] = slr_sum
+        return util_sum
 
-                    for line in report:
-                        # print(line)
-                        for rs, expr in expression_map.items():
-                            # print(rs)
-                            util = matchRE(expr, line)
-                            if util:
-                                util_sum[rs] = util
 
-                return util_sum
+class TimingReport:
 
-            return getUtil(utilization_report_path)
-        else:
-            printError(
-                "Synthesis report " + utilization_report_path + " does not exist")
-            return None
+    """
+    Streaming parser of Vivado timing summaries (report_timing_summary). The
+    report is read one line at a time by a small state machine, so memory does
+    not grow with the report. paths() yields the timing paths as they are read
+    and can stop after the first few. summary holds the Design Timing Summary
+    table (wns, tns, whs, ths, ...) once it is read, Vivado writes it before
+    the paths.
+    """
+
+    SLACK = re.compile(
+        r'Slack\s*\((VIOLATED|MET)\)\s*:\s*([+-]?([0-9]+([.][0-9]*)?|[.][0-9]+))\w*\s*\(required time - arrival time\)')
+    FIELD = re.compile(r'\s*(Source|Destination|Requirement):\s*(\S+)')
+    TIME = re.compile(r'[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)')
+    COLUMNS = re.compile(r'\s{2,}')
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.summary = None
+        self.table = None
+        self.columns = None
 
-    def __get_timing_report__(timing_report_path):
+    def __column__(name):
+        return name.replace('(ns)', '').strip().lower().replace(' ', '_')
+
+    def __value__(value):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+
+    def __summary__(self, line):
         """
-        Extract the timing violation and return a list of violations
+        Advance the state machine of the Design Timing Summary table
         """
-        if not os.path.exists(timing_report_path):
-            printError(
-                "Timing report " + timing_report_path + " does not exists")
-            return None
+        stripped = line.strip()
+        if self.table == None:
+            if stripped.startswith('|') and stripped[1:].strip() == 'Design Timing Summary':
+                self.table = 'title'
+        elif self.table == 'title':
+            if stripped.startswith('WNS(ns)'):
+                self.columns = [TimingReport.__column__(c)
+                                for c in TimingReport.COLUMNS.split(stripped)]
+                self.table = 'header'
+        elif self.table == 'header':
+            if stripped.startswith('-'):
+                self.table = 'rule'
+        elif self.table == 'rule' and stripped != '':
+            self.summary = dict(zip(self.columns, [
+                TimingReport.__value__(v) for v in stripped.split()]))
+            self.table = 'done'
+
+    def paths(self, limit=None):
+        """
+        Yield the timing paths of the report in order as dictionaries with the
+        slack, source, destination, requirement and allowed time, stops after
+        limit paths when given
+        """
+        count = 0
+        path = None
+        for line in self.fp:
+            if self.table != 'done':
+                self.__summary__(line)
+            matches = TimingReport.SLACK.match(line)
+            if matches:
+                path = {'slack': float(matches.group(2))}
+                continue
+            if path == None:
+                continue
+            matches = TimingReport.FIELD.match(line)
+            if not matches:
+                continue
+            (field, value) = matches.groups()
+            if field != 'Requirement':
+                path[field.lower()] = value
+                continue
+            required = TimingReport.TIME.match(value)
+            if required and 'source' in path and 'destination' in path:
+                required = float(required.group(0))
+                yield {
+                    'slack': path['slack'],
+                    'source': path['source'],
+                    'destination': path['destination'],
+                    'requirement': required,
+                    'allowed': required - path['slack']
+                }
+                count += 1
+                if limit != None and count >= limit:
+                    return
+            path = None
+
+    def worst(self, n):
+        """
+        The n paths with the least slack in the whole report, only n paths are
+        held in memory at any time
+        """
+        return heapq.nsmallest(n, self.paths(), key=lambda p: p['slack'])
 
-        regex_slack_violation = re.compile(
-            r'Slack\s*\((VIOLATED|MET)\)\s*:\s*([+-]?([0-9]+([.][0-9]*)?|[.][0-9]+))\w*\s*\(required time - arrival time\)')
 
-        t = 'Slack (MET) :        0.107ns  (required time - arrival time)\n'
-        m = matches = regex_slack_violation.match(t)
+class Utilities:
 
+    def forceMakeDirectory(path):
+        """
+        Recursively creates fresh directories given by the path. If a directory
+        tree already exits at the path, it will be removed.
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
 
-        with open(timing_report_path, 'r') as fp:
-            lines = fp.readlines()
+    @contextlib.contextmanager
+    def __open_report__(report):
+        """
+        Text stream of a report given either as a path or as an open stream
+        (e.g., an artifact read from a zip), streams are not closed
+        """
+        if isinstance(report, str):
+            with open(report, 'r') as fp:
+                yield fp
+        else:
+            yield report
 
-            slack_violations = []
-            for ln_num, ln in enumerate(lines):
+    def __get_utilization_report__(utilization_report_path, slr=False):
+        """
+        extract synthesis utilizatino report and return it in a dictionary,
+        the report is either a path or an open text stream
+        """
+        if isinstance(utilization_report_path, str) and \
+                not os.path.exists(utilization_report_path):
+            printError(
+                "Synthesis report " + utilization_report_path + " does not exist")
+            return None
 
+        with Utilities.__open_report__(utilization_report_path) as util_fp:
+            return UtilizationReport(util_fp, slr).parse()
 
-                matches = regex_slack_violation.match(ln)
-                if matches:
+    def __get_timing_report__(timing_report_path, limit=None):
+        """
+        Extract the timing violation and return a list of violations, the
+        report is either a path or an open text stream. Only the limit paths
+        with the least slack are kept when limit is given.
+        """
+        if isinstance(timing_report_path, str) and \
+                not os.path.exists(timing_report_path):
+            printError(
+                "Timing report " + timing_report_path + " does not exists")
+            return None
 
-                    slack = float(matches.group(2))
-                    source = lines[ln_num + 1].split()[1]
-                    dest = lines[ln_num + 3].split()[1]
-                    required = float(lines[ln_num + 7].split()[1][0:-2])
-                    slack_violations.append({
-                        'slack': slack,
-                        'source': source,
-                        'destination': dest,
-                        'requirement': required,
-                        'allowed': required - slack
-                    })
-            return slack_violations
+        with Utilities.__open_report__(timing_report_path) as fp:
+            if limit != None:
+                return TimingReport(fp).worst(limit)
+            return list(TimingReport(fp).paths())
 
     def __get_synthesis_report__(extract_dir):
         """
@@ -425,7 +2230,51 @@ class Utilities:
             'utilization': util_report,
             'timing': timing_report
         }
-    def __get_instance_report__(hls_build_dir):
+    EXPORT_RESOURCES = ['SLICE', 'LUT', 'FF', 'DSP', 'BRAM', 'SRL', 'URAM']
+    EXPORT_LINE = re.compile(
+        r'(?:(SLICE|LUT|FF|DSP|BRAM|SRL|URAM):\s*(\d*)'
+        r'|CP (required|achieved post-synthesis):\s*(\d*\.\d*))')
+
+    def __summarize_export_report__(report_fp):
+        """
+        Resources and clock periods of an hls project from its export report,
+        given as a text stream, in a single pass over its lines
+        """
+        resources = dict((r, None) for r in Utilities.EXPORT_RESOURCES)
+        timing = {'cp_required': None, 'cp_achieved': None}
+        for line in report_fp:
+            matches = Utilities.EXPORT_LINE.match(line)
+            if not matches:
+                continue
+            (resource, used, cp, period) = matches.groups()
+            if resource != None:
+                if resources[resource] == None:
+                    resources[resource] = int(used)
+            elif cp == 'required':
+                timing['cp_required'] = float(period)
+            else:
+                timing['cp_achieved'] = float(period)
+        return {
+            'resources': resources,
+            'timing': timing
+        }
+
+    def __summarize_export_file__(report_file_path):
+        with open(report_file_path, 'r') as fp:
+            return Utilities.__summarize_export_report__(fp)
+
+    def __summarize_export_text__(text):
+        return Utilities.__summarize_export_report__(io.StringIO(text))
+
+    def __export_pool__(workers):
+        """
+        Process pool the export reports are summarized on, None when they are
+        summarized in the calling process (e.g., when it is a worker itself)
+        """
+        workers = workers if workers != None else (os.cpu_count() or 1)
+        return ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def __get_instance_report__(hls_build_dir, workers=None):
         
         def __check_report_exists__(hls_project_path, project_name):
             report_file_path = hls_project_path + '/' + project_name + \
@@ -437,52 +2286,72 @@ class Utilities:
             else:
                 return report_file_path
 
-        def __inner_summarize__(hls_project_path, project_name):
-            report_file_path = __check_report_exists__(
-                hls_project_path, project_name)
-            if report_file_path:
-
-                def __extract_resource__(resource):
-                    regex = re.compile(r'' + resource + r':\s*(\d*)')
-                    with open(report_file_path, 'r') as fp:
-                        lines = fp.readlines()
-                        for line in lines:
-                            matches = regex.match(line)
-                            if matches:
-                                used = int(matches.group(1))
-                                return used
-
-                def __extract_cp__():
-                    regex_req = re.compile(r'CP required:\s*(\d*\.\d*)')
-                    regex_achv = re.compile(
-                        r'CP achieved post-synthesis:\s*(\d*\.\d*)')
-                    res = {'cp_required': None, 'cp_achieved': None}
-                    with open(report_file_path, 'r') as fp:
-                        lines = fp.readlines()
-                        for line in lines:
-                            matches = regex_req.match(line)
-                            if matches:
-                                res['cp_required'] = float(
-                                    matches.group(1))
-                            matches = regex_achv.match(line)
-                            if matches:
-                                res['cp_achieved'] = float(
-                                    matches.group(1))
-                    return res
-
-                reources = ['SLICE', 'LUT', 'FF', 'DSP', 'BRAM', 'SRL', 'URAM']
-                utils = [__extract_resource__(r) for r in reources]
-                return {
-                    'resources': dict(zip(reources, utils)),
-                    'timing': __extract_cp__()
-                }
-            else:
-                return None
-
         hls_projects_root = hls_build_dir
         summary = {}
-        for dir in os.listdir(hls_projects_root):
-            print("Extracting reports for " + dir)
-            summary[dir] = __inner_summarize__(hls_projects_root, dir)
+        pending = {}
+        pool = Utilities.__export_pool__(workers)
+        try:
+            for dir in os.listdir(hls_projects_root):
+                print("Extracting reports for " + dir)
+                summary[dir] = None
+                report_file_path = __check_report_exists__(hls_projects_root, dir)
+                if report_file_path == None:
+                    continue
+                if pool != None:
+                    pending[dir] = pool.submit(
+                        Utilities.__summarize_export_file__, report_file_path)
+                else:
+                    summary[dir] = Utilities.__summarize_export_file__(
+                        report_file_path)
+            for (dir, future) in pending.items():
+                summary[dir] = future.result()
+        finally:
+            if pool != None:
+                pool.shutdown()
+        print("Extracted %d reports" % (len(summary)))
+        return summary
+
+    def __get_instance_report_archive__(tar_fp, hls_build_dir='build/vivado-hls', workers=None):
+        """
+        Same as __get_instance_report__ but for an instance_reports.tar.gz
+        given as a binary stream. The tar is read sequentially and each export
+        report is parsed straight from the archive, without extracting it.
+        """
+        projects_root = hls_build_dir.strip('/') + '/'
+        summary = {}
+        pending = {}
+        pool = Utilities.__export_pool__(workers)
+        try:
+            with tarfile.open(fileobj=tar_fp, mode='r|gz') as tar:
+                for member in tar:
+                    name = member.name[2:] if member.name.startswith('./') else member.name
+                    if not name.startswith(projects_root):
+                        continue
+                    project_name = name[len(projects_root):].split('/')[0]
+                    if project_name == '':
+                        continue
+                    if not project_name in summary:
+                        summary[project_name] = None
+                    report_name = projects_root + project_name + \
+                        '/solution/impl/report/verilog/' + project_name + '_export.rpt'
+                    if name == report_name and member.isfile():
+                        print("Extracting reports for " + project_name)
+                        # members of a streamed tar are not seekable, which
+                        # TextIOWrapper needs, a report is small enough to decode
+                        text = tar.extractfile(member).read().decode(errors='replace')
+                        if pool != None:
+                            pending[project_name] = pool.submit(
+                                Utilities.__summarize_export_text__, text)
+                        else:
+                            summary[project_name] = \
+                                Utilities.__summarize_export_text__(text)
+            for (project_name, future) in pending.items():
+                summary[project_name] = future.result()
+        finally:
+            if pool != None:
+                pool.shutdown()
+        for project_name, report in summary.items():
+            if report == None:
+                printError("Report file for " + project_name + " does not exist")
         print("Extracted %d reports" % (len(summary)))
-        return summary
\ No newline at end of file
+        return summary
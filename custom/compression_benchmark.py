@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import inspect
+import time
+
+try:
+    from .. import StreamblocksBuild
+except ImportError as e:
+    currentdir = os.path.dirname(os.path.abspath(
+        inspect.getfile(inspect.currentframe())))
+    parentdir = os.path.dirname(currentdir)
+    sys.path.insert(0, parentdir)
+    import StreamblocksBuild
+
+
+"""
+Compress a generated configuration directory with every submission archive
+compression backend and report the time it took against the archive size
+"""
+
+
+class ByteCounter:
+    """
+    Sink that only counts the bytes written to it, so that disk writes do not
+    get in the measurements
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        "Benchmark the compression backends of submission archives")
+    arg_parser.add_argument('dir', type=str, metavar='DIR',
+                            help='generated configuration directory, e.g., configuration_4_3.3')
+    arg_parser.add_argument('--levels', '-l', type=int, nargs='+', default=[1, 6, 9],
+                            help='gzip levels to try')
+    arg_parser.add_argument('--workers', '-w', type=int, default=None,
+                            help='pgzip compression threads, all cores by default')
+    arg_parser.add_argument('--repeat', '-r', type=int, default=1,
+                            help='number of times each backend is run, the best time is reported')
+    args = arg_parser.parse_args()
+
+    sources = StreamblocksBuild.JenkinsJob.TAR_SOURCES
+    if not any(os.path.exists(os.path.join(args.dir, s)) for s in sources):
+        StreamblocksBuild.printError(
+            "None of " + ", ".join(sources) + " found in " + args.dir)
+        sys.exit(1)
+
+    backends = [StreamblocksBuild.Compression('none')]
+    for level in args.levels:
+        backends.append(StreamblocksBuild.Compression('gzip', level))
+        backends.append(StreamblocksBuild.Compression(
+            'pgzip', level, args.workers))
+
+    results = []
+    for compression in backends:
+        best = None
+        for _ in range(args.repeat):
+            sink = ByteCounter()
+            start = time.perf_counter()
+            compression.archive(sink, args.dir, sources)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best == None else min(best, elapsed)
+        results.append((str(compression), best, sink.size))
+        print("%-10s %8.2f s %10.2f MB" % (str(compression), best, sink.size / 1e6))
+
+    plain_size = results[0][2]
+    print("\n%-10s %10s %12s %8s %10s" %
+          ('backend', 'time (s)', 'size (MB)', 'ratio', 'MB/s in'))
+    for (name, elapsed, size) in results:
+        print("%-10s %10.2f %12.2f %8.2f %10.2f" % (
+            name, elapsed, size / 1e6, plain_size / max(size, 1),
+            plain_size / max(elapsed, 1e-6) / 1e6))
@@ -2,13 +2,85 @@
 import json
 import argparse
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 import os
 import shutil
+import tempfile
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 """
 Custom script to extract and copy artifacts to custom directories using
 special path strings containing @SOL_NUMBER@, @CORES@, @INDEX@. This is
 used with the output of the ilp solver... you do not need to use it:D
+
+Every unique artifact is extracted once (only its xclbin directory), and
+placed in the binary directories of the solutions that share it with hard
+links, reflinks or symbolic links instead of copies. Each run extracts into
+its own directory under ./extract, kept with symbolic links.
 """
+
+# members of artifacts.zip that are placed in the binary directories
+XCLBIN_PREFIX = "archive/project/bin/xclbin/"
+# ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+LINK_MODES = ['hard', 'sym', 'reflink', 'copy']
+
+
+def extractXclbin(artifact_path, extract_dir):
+  """
+  Extract the members under project/bin/xclbin of an artifact archive into
+  extract_dir, returns the number of extracted members
+  """
+  with ZipFile(artifact_path, 'r') as f:
+    members = [m for m in f.namelist() if m.startswith(XCLBIN_PREFIX)]
+    f.extractall(extract_dir, members)
+  return len(members)
+
+
+def hardLink(src, dst):
+  try:
+    os.link(src, dst)
+  except OSError:
+    # e.g., the extract directory is on another file system
+    shutil.copy2(src, dst)
+
+
+def refLink(src, dst):
+  if fcntl != None:
+    try:
+      with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+        fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+      shutil.copystat(src, dst)
+      return
+    except OSError:
+      pass
+  shutil.copy2(src, dst)
+
+
+def placeXclbin(src_dir, dst_dir, link):
+  """
+  Place the extracted xclbin directory src_dir at dst_dir
+  """
+  if os.path.islink(dst_dir):
+    os.unlink(dst_dir)
+  elif os.path.exists(dst_dir):
+    print("""
+            overwriting existing files
+                """)
+    shutil.rmtree(dst_dir)
+  os.makedirs(os.path.dirname(os.path.abspath(dst_dir)), exist_ok=True)
+  if link == 'sym':
+    os.symlink(os.path.abspath(src_dir), dst_dir, target_is_directory=True)
+  elif link == 'hard':
+    shutil.copytree(src_dir, dst_dir, copy_function=hardLink)
+  elif link == 'reflink':
+    shutil.copytree(src_dir, dst_dir, copy_function=refLink)
+  else:
+    shutil.copytree(src_dir, dst_dir)
+
+
 if __name__ == "__main__":
 
     binary_path_example = \
@@ -25,27 +97,39 @@ if __name__ == "__main__":
     with core count and solution number for each partition. Example:
     -b {example}
 
-    """.format(example=binary_path_example), 
+    """.format(example=binary_path_example),
     metavar="STRING", required=True, type=str)
 
     arg_parser.add_argument(
       "-a", "--artifact-pattern", help="""
     Artifact path pattern to the artifact.zip file fetched from jenkins.
     It should include an @INDEX@ substring represeting the unique partition
-    index. Example: 
+    index. Example:
     -a {example}
 
     """.format(example=artifact_path_example),
     metavar="STRING", required=True, type=str
     )
-    
-    arg_parser.add_argument('-m', "--mapping", required=True, type=str, 
+
+    arg_parser.add_argument('-m', "--mapping", required=True, type=str,
     metavar='PATH',  help="""
     Path to json file which maps each heterogeneous solution to the unique
     hardware partition index. Example:
     -m heterogeneous/hardware.json
     """)
 
+    arg_parser.add_argument('-l', "--link", choices=LINK_MODES, default='hard',
+    help="""
+    How the xclbin files are placed in the binary directories: hard links
+    (default), symbolic links to the extract directory of the run (which is
+    then kept under ./extract),
+    reflinks on copy-on-write file systems or plain copies. Hard links and
+    reflinks fall back on copies where the file system does not support them.
+    """)
+
+    arg_parser.add_argument('-j', "--workers", type=int, default=4,
+    help="number of artifacts extracted in parallel")
+
     args = arg_parser.parse_args()
 
 
@@ -58,79 +142,87 @@ if __name__ == "__main__":
       solutions = mappings['solutions']
       print("There are %d solutions"%mappings['count'])
       pwd = os.getcwd()
-      tmp_dir = pwd + "/extract"
+      # every run extracts into its own directory, the symbolic links of
+      # earlier runs point into theirs
+      os.makedirs(pwd + "/extract", exist_ok=True)
+      tmp_dir = tempfile.mkdtemp(prefix="run_", dir=pwd + "/extract")
 
       print("Creating temp directory in " + tmp_dir)
-      try: 
-        os.makedirs(tmp_dir)
-      except FileExistsError:
-        shutil.rmtree(tmp_dir + "/")
-        
-      
-      extracted_artifacts = set()
+
+
       try:
+        placements = []
         for sol in solutions:
           try:
             cores = sol['cores']
             sol_number = sol['index']
             unique_index = sol['hash_index']
-            bin_dir = args.bin_pattern.replace("@CORES@", str(cores))
-            bin_dir = bin_dir.replace("@SOL_NUMBER@", str(sol_number))
-          
-            
-            artifact_dir = args.artifact_pattern.replace("@INDEX@", 
-              str(unique_index))
-            
-            
-            print("""
+          except KeyError as e:
+            raise KeyError("Invalid Solution entry!: \n" + str(e))
+          bin_dir = args.bin_pattern.replace("@CORES@", str(cores))
+          bin_dir = bin_dir.replace("@SOL_NUMBER@", str(sol_number))
+          artifact_dir = args.artifact_pattern.replace("@INDEX@",
+            str(unique_index))
+          placements.append((cores, sol_number, unique_index, bin_dir, artifact_dir))
+
+        # extract every unique artifact once, in parallel
+        artifacts = {}
+        for (_, _, unique_index, _, artifact_dir) in placements:
+          if os.path.isfile(artifact_dir):
+            artifacts[unique_index] = artifact_dir
+
+        def extract(unique_index):
+          extract_dir = tmp_dir + "/" + str(unique_index)
+          os.makedirs(extract_dir, exist_ok=True)
+          try:
+            return (unique_index, extractXclbin(artifacts[unique_index], extract_dir))
+          except Exception as e:
+            return (unique_index, e)
+
+        extracted_artifacts = set()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+          for (unique_index, result) in executor.map(extract, sorted(artifacts.keys())):
+            if isinstance(result, Exception):
+              print("""
+            could not extract {file}: {err}
+            """.format(file=artifacts[unique_index], err=result))
+            else:
+              print("""
+            extracted {n} xclbin files of {file}
+            """.format(n=result, file=artifacts[unique_index]))
+              extracted_artifacts.add(unique_index)
+
+        for (cores, sol_number, unique_index, bin_dir, artifact_dir) in placements:
+          print("""
             -----------------------cores: {c:2d} number: {n:2d}---------------------------
-            bin directory: 
+            bin directory:
             {bin_dir}
             artifact directory:
-            {artifact_dir}""".format(c=cores, n=sol_number, 
-              bin_dir=bin_dir, artifact_dir=artifact_dir))
-            if not os.path.isfile(artifact_dir):
-              print("""
+            {artifact_dir}""".format(c=cores, n=sol_number,
+            bin_dir=bin_dir, artifact_dir=artifact_dir))
+          if not os.path.isfile(artifact_dir):
+            print("""
             artifact file does not exits! Skipping copy.
             """)
-            else:
-            
-              if not (unique_index in extracted_artifacts):
-                extract_dir = tmp_dir + "/" + str(unique_index)
-                if not os.path.exists(extract_dir):
-                  os.makedirs(extract_dir)
-                print("""
-            extracting artifacts into {}
-              """.format(extract_dir))
-              
-                with ZipFile(artifact_dir, 'r') as f:
-                  f.extractall(extract_dir)
-                
-                extracted_artifacts.add(unique_index)
-              print("""
-            copying artifacts
+          elif not unique_index in extracted_artifacts:
+            print("""
+            artifact file could not be extracted! Skipping copy.
             """)
-              src_dir = extract_dir + "/archive/project/bin/xclbin"
-              dst_dir = bin_dir + '/xclbin'
-              if os.path.exists(dst_dir):
-                print("""
-            overwriting existing files
-                """)
-                shutil.rmtree(dst_dir)
-              shutil.copytree(src_dir, dst_dir)
+          else:
             print("""
+            placing artifacts ({link})
+            """.format(link=args.link))
+            src_dir = tmp_dir + "/" + str(unique_index) + "/archive/project/bin/xclbin"
+            dst_dir = bin_dir + '/xclbin'
+            placeXclbin(src_dir, dst_dir, args.link)
+          print("""
             ======================================================================
             """)
-          
-          
-          except KeyError as e:
-            raise KeyError("Invalid Solution entry!: \n" + e)
-          
+
       except Exception as e:
         print("Errors occured! \n" + str(e))
         # shutil.rmtree(tmp_dir)
-      
-      shutil.rmtree(tmp_dir)
-        
-
 
+      # symbolic links point into the extract directory
+      if args.link != 'sym':
+        shutil.rmtree(tmp_dir)
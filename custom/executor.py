@@ -1,18 +1,60 @@
 import subprocess
 import re 
 import json
+import argparse
+import csv
+import sys
+import os
+import inspect
+import hashlib
+import threading
+import queue
+import signal
+import collections
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import time
 import pathlib
 
+try:
+  from .. import StreamblocksBuild
+except ImportError as e:
+  currentdir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+  parentdir = os.path.dirname(currentdir)
+  sys.path.insert(0, parentdir)
+  import StreamblocksBuild
+
 class PartitionExecutor:
+  """
+  Runs the binaries of heterogeneous solutions. When an xclbin path pattern
+  is given, the device is programmed with the xclbin of a solution before it
+  runs, unless the same xclbin (by content) is already loaded. The command
+  programming the device is a template with an {xclbin} field, so that it
+  can be replaced by a stub when there is no device.
+  """
 
+  PROGRAM_COMMAND = 'xbutil program -p {xclbin}'
+  # throughput line printed by the binaries, once per loop (--l)
+  FPS_LINE = re.compile(r'(\d*) images in (\d*\.\d*) seconds: (\d*\.\d*) FPS')
 
-  def __init__(self, partitions_path, bin_path):
+  def __init__(self, partitions_path, bin_path, xclbin_path=None,
+    program_command=PROGRAM_COMMAND):
 
     self.bin_path = bin_path
     self.partitions_path = partitions_path
+    self.xclbin_path = xclbin_path
+    self.program_command = program_command
+    # content hash of the xclbin loaded on the device, if known
+    self.loaded = None
+    self.hashes = {}
+    self.programmed = 0
+    self.skipped = 0
+    self.program_time = 0.0
+    # stdbuf line buffers the output of the binaries, see runSolution
+    self.stdbuf = shutil.which('stdbuf')
 
     with  open (partitions_path + '/heterogeneous/hardware.json', 'r') as m_file:
       
@@ -20,17 +62,109 @@ class PartitionExecutor:
       self.mapping = json.load(m_file)
       print('There are %d solutions'%len(self.mapping['solutions']))
 
+  def uniqueIndex(solution):
+    try:
+      return solution['hash_index']
+    except KeyError:
+      try:
+        return solution['index']
+      except KeyError:
+        raise KeyError('Invalid solution format: ' + 
+          json.dumps(solution, indent=4) + "\n missing \'index\' entry")
+
+  def xclbinHash(self, xclbin):
+    """
+    Content hash of an xclbin, only computed again when the file changes
+    """
+    stat = os.stat(xclbin)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = self.hashes.get(xclbin)
+    if cached == None or cached[0] != key:
+      digest = hashlib.sha256()
+      with open(xclbin, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+          digest.update(block)
+      cached = (key, digest.hexdigest())
+      self.hashes[xclbin] = cached
+    return cached[1]
+
   def programDevice(self, xclbin):
+    """
+    Program the device with xclbin unless it is already loaded, returns
+    whether the device was programmed
+    """
+    digest = self.xclbinHash(xclbin)
+    if digest == self.loaded:
+      self.skipped += 1
+      return False
 
-    shell_command = 'xbutil program -p ' + xclbin
+    shell_command = self.program_command.format(xclbin=xclbin)
+    start = time.monotonic()
     run = subprocess.run(shell_command, shell=True)
+    self.program_time += time.monotonic() - start
 
     if run.returncode != 0:
+      # a failed attempt may leave anything on the device
+      self.loaded = None
       raise RuntimeError("""
     could not program the device using {file}
       """.format(file=xclbin))
+    self.loaded = digest
+    self.programmed += 1
+    return True
+
+  def programSolution(self, solution):
+    """
+    Program the device with the xclbin of solution, if xclbins are used
+    """
+    if self.xclbin_path == None:
+      return False
+    unique_index = PartitionExecutor.uniqueIndex(solution)
+    xclbin = self.xclbin_path.replace("@INDEX@", str(unique_index))
+    if not os.path.isfile(xclbin):
+      raise RuntimeError("xclbin file " + xclbin + " does not exits")
+    return self.programDevice(xclbin)
+
+  def schedule(self, solutions):
+    """
+    Order the solutions so that the ones sharing a hash_index run back to
+    back, groups keep the order of their first solution
+    """
+    first = {}
+    for (position, sol) in enumerate(solutions):
+      first.setdefault(PartitionExecutor.uniqueIndex(sol), position)
+    return sorted(solutions, key=lambda sol: first[PartitionExecutor.uniqueIndex(sol)])
+
+  def programmingSummary(self, solutions=None):
+    """
+    Number of times the device was programmed and the time it took, compared
+    to programming it for every change of hash_index in the order of
+    solutions (e.g., the mapping order) when given
+    """
+    summary = "Programmed the device %d times (%.1f s), skipped %d" % (
+      self.programmed, self.program_time, self.skipped)
+    if solutions != None and self.programmed > 0:
+      indices = [PartitionExecutor.uniqueIndex(sol) for sol in solutions]
+      naive = len([i for i in range(len(indices)) if i == 0 or indices[i] != indices[i - 1]])
+      saved = max(naive - self.programmed, 0)
+      summary += ", %d fewer than in mapping order (about %.1f s saved)" % (
+        saved, saved * self.program_time / self.programmed)
+    return summary
   
-  def runSolution(self, solution, args=''):
+  def runSolution(self, solution, args='', timeout=None, hang_timeout=None, on_sample=None):
+    """
+    Run the binary of solution and return the (frames, time, fps) samples of
+    every throughput line it printed, or None if it failed. The output is
+    parsed line by line as it is printed, and on_sample is called with each
+    sample as soon as it is read. The binary is killed after timeout seconds,
+    or when it prints nothing for hang_timeout seconds.
+
+    The output of the binary is a pipe, which libc block-buffers, so the
+    binary is run under stdbuf -oL to get its lines as they are printed.
+    Without stdbuf (or for a binary that sets its own buffering) samples
+    arrive in bursts, and hang_timeout is only meaningful if the binary
+    flushes every line.
+    """
 
     cores = 0
     try:
@@ -44,20 +178,12 @@ class PartitionExecutor:
       sol_number = solution['index']
     except KeyError:
       try:
-        sol_number = solutoin['sol_number']
+        sol_number = solution['sol_number']
       except KeyError:
         raise KeyError('Invalid solution format: ' + 
           json.dumps(solution, indent=4) + "\n missing \'sol_number\' entry")
 
-    unique_index = 0
-    try:
-      unique_index = solution['hash_index']
-    except KeyError:
-      try:
-        unique_index = solution['index']
-      except KeyError:
-        raise KeyError('Invalid solution format: ' + 
-          json.dumps(solution, indent=4) + "\n missing \'index\' entry")
+    unique_index = PartitionExecutor.uniqueIndex(solution)
 
   
     binary_path = pathlib.Path(self.bin_path.replace("@INDEX@", str(unique_index)))
@@ -73,38 +199,281 @@ class PartitionExecutor:
 
     shell_command = './' + str(program_name) + ' ' + args
 
-    run = subprocess.run(shell_command, shell=True, stdout=subprocess.PIPE, cwd=str(exec_dir))
+    run_command = shell_command
+    if self.stdbuf != None:
+      # line buffered stdout, see above
+      run_command = self.stdbuf + ' -oL ' + shell_command
 
-    if run.returncode != 0:
+    # a new session so that the whole process group (the shell and the
+    # binary) can be killed
+    process = subprocess.Popen(run_command, shell=True, stdout=subprocess.PIPE,
+      cwd=str(exec_dir), start_new_session=True)
+
+    lines = queue.Queue()
+    def pump():
+      for ln in iter(process.stdout.readline, b''):
+        lines.put(ln)
+      lines.put(None)
+    threading.Thread(target=pump, daemon=True).start()
+
+    samples = []
+    # only the end of the output is kept for error messages
+    tail = collections.deque(maxlen=50)
+    start = time.monotonic()
+    last_output = start
+    while True:
+      now = time.monotonic()
+      deadlines = []
+      if timeout != None:
+        deadlines.append((start + timeout, 'timed out after %.1f seconds' % timeout))
+      if hang_timeout != None:
+        deadlines.append((last_output + hang_timeout,
+          'printed nothing for %.1f seconds' % hang_timeout))
+      deadline = min(deadlines) if deadlines else None
+      try:
+        ln = lines.get(timeout=max(deadline[0] - now, 0) if deadline else None)
+      except queue.Empty:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        raise RuntimeError("{cmd} in {dir} {reason}, killed it".format(
+          cmd=shell_command, dir=exec_dir, reason=deadline[1]))
+      if ln == None:
+        break
+      last_output = time.monotonic()
+      ln = ln.decode("utf-8", errors="replace")
+      tail.append(ln)
+      matches = PartitionExecutor.FPS_LINE.match(ln)
+      if (matches != None):
+        sample = (int(matches.group(1)), float(matches.group(2)), float(matches.group(3)))
+        samples.append(sample)
+        if on_sample != None:
+          on_sample(sample)
+
+    returncode = process.wait()
+    if returncode != 0:
       print(""" 
       Failed to execute:
       {cmd}
       in direcotory {dir}, program returned {code}
 
       {err}
-      """.format(cmd=shell_command, dir=exec_dir, code=run.returncode, err=run.stdout))
+      """.format(cmd=shell_command, dir=exec_dir, code=returncode, err=''.join(tail)))
       return None
-    else:
-      regex = re.compile(r'(\d*) images in (\d*\.\d*) seconds: (\d*\.\d*) FPS')
-      perf = {'frames' : 0, 'trips' : 0, 'time' : 0}
-      for ln in run.stdout.decode("utf-8").split('\n'):
-        # print(ln)
-        matches = regex.match(ln)
-        if (matches != None):
-          frames = int(matches.group(1))
-          exec_time = float(matches.group(2))
-          fps = float(matches.group(3))
-          return (frames, exec_time, fps)
-      
+    if len(samples) == 0:
       raise RuntimeError("Could not measure performance!")
-      
+    return samples
 
 
 
-if __name__ == "__main__":
+class PartitionBenchmark:
+  """
+  Runs every solution of the mapping file with PartitionExecutor.runSolution,
+  warmup times unmeasured and then trials times, and aggregates the frames,
+  time and fps of the measured trials. A trial sums the frames and time of
+  all the loops of the binary. Each solution is written to the csv
+  and json tables as soon as it is measured. Solutions only run concurrently
+  (on workers threads) when they do not use the device. Otherwise they run
+  grouped by hash_index, so that the device is programmed once per group.
+  """
 
-  
-  executor = PartitionExecutor('pwr_fixed', 'unique_@INDEX@_3.3/bin/Top_RVC_Decoder')
-  executor.runSolution({'index' : 0, 'sol_number' : 0, 'cores' : 1}, '--i=foreman_qcif_30.bit --l=1')
+  FIELDS = ['index', 'cores', 'hash_index', 'trials', 'failures', 'frames',
+    'time_mean', 'time_median', 'time_stdev',
+    'fps_mean', 'fps_median', 'fps_stdev', 'fps_ci_low', 'fps_ci_high']
+
+  def __init__(self, executor, warmup=1, trials=5, args='', confidence=0.95,
+    device=True, workers=1, resamples=10000, timeout=None, hang_timeout=None,
+    verbose=False):
+
+    self.executor = executor
+    self.warmup = warmup
+    self.trials = trials
+    self.args = args
+    self.confidence = confidence
+    self.device = device
+    self.workers = workers if not device else 1
+    self.resamples = resamples
+    self.timeout = timeout
+    self.hang_timeout = hang_timeout
+    self.verbose = verbose
+
+  def confidenceInterval(self, samples):
+    """
+    Bootstrap confidence interval of the mean of samples
+    """
+    if len(samples) < 2:
+      return (float('nan'), float('nan'))
+    rng = np.random.default_rng(0)
+    means = rng.choice(samples, size=(self.resamples, len(samples))).mean(axis=1)
+    alpha = (1 - self.confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return (float(low), float(high))
+
+  def summarize(self, solution, samples, failures):
+    """
+    Row of the result tables for the measured (frames, time, fps) samples
+    """
+    row = {
+      'index': solution.get('index'),
+      'cores': solution.get('cores'),
+      'hash_index': solution.get('hash_index'),
+      'trials': len(samples),
+      'failures': failures
+    }
+    if len(samples) == 0:
+      for field in PartitionBenchmark.FIELDS[5:]:
+        row[field] = None
+      return row
+    table = np.array(samples, dtype=np.float64)
+    (frames, times, fps) = (table[:, 0], table[:, 1], table[:, 2])
+    stdev = lambda v: float(np.std(v, ddof=1)) if len(v) > 1 else 0.0
+    (ci_low, ci_high) = self.confidenceInterval(fps)
+    row.update({
+      'frames': int(np.median(frames)),
+      'time_mean': float(np.mean(times)),
+      'time_median': float(np.median(times)),
+      'time_stdev': stdev(times),
+      'fps_mean': float(np.mean(fps)),
+      'fps_median': float(np.median(fps)),
+      'fps_stdev': stdev(fps),
+      'fps_ci_low': ci_low,
+      'fps_ci_high': ci_high
+    })
+    return row
+
+  def measure(self, solution):
+    """
+    Run the trials of a solution, returns the row of the result tables and
+    the (frames, time, fps) sample of every trial, along with the samples of
+    the loops of every trial
+    """
+    samples = []
+    iterations = []
+    failures = 0
+    if self.device:
+      try:
+        self.executor.programSolution(solution)
+      except RuntimeError as e:
+        print(str(e))
+        return (self.summarize(solution, samples, self.trials), samples, iterations)
+    on_sample = None
+    if self.verbose:
+      on_sample = lambda sample: print('  solution %s (%s cores): %d images in %.3f s, %.2f FPS' % (
+        solution.get('index'), solution.get('cores'), sample[0], sample[1], sample[2]))
+    for trial in range(self.warmup + self.trials):
+      try:
+        result = self.executor.runSolution(solution, self.args, self.timeout,
+          self.hang_timeout, on_sample)
+      except RuntimeError as e:
+        print(str(e))
+        result = None
+      if trial < self.warmup:
+        continue
+      if result == None:
+        failures += 1
+      else:
+        loops = np.array(result, dtype=np.float64)
+        frames = int(loops[:, 0].sum())
+        exec_time = float(loops[:, 1].sum())
+        samples.append((frames, exec_time, frames / exec_time if exec_time > 0 else float('nan')))
+        iterations.append(result)
+    return (self.summarize(solution, samples, failures), samples, iterations)
+
+  def run(self, csv_path=None, json_path=None):
+    """
+    Measure all the solutions, returns the rows of the result tables in the
+    order solutions finished
+    """
+    csv_fp = open(csv_path, 'w', newline='') if csv_path != None else None
+    json_list = StreamblocksBuild.JsonListWriter(json_path) if json_path != None else None
+    rows = []
+    try:
+      writer = None
+      if csv_fp != None:
+        writer = csv.DictWriter(csv_fp, fieldnames=PartitionBenchmark.FIELDS)
+        writer.writeheader()
+        csv_fp.flush()
+
+      def record(row, samples, iterations):
+        rows.append(row)
+        print('solution %s (%s cores): %s fps (median), %d/%d trials' % (
+          row['index'], row['cores'], row['fps_median'], row['trials'], self.trials))
+        if writer != None:
+          writer.writerow(row)
+          csv_fp.flush()
+        if json_list != None:
+          entry = dict(row)
+          entry['samples'] = [
+            {'frames': f, 'time': t, 'fps': fps, 'iterations': [
+              {'frames': lf, 'time': lt, 'fps': lfps} for (lf, lt, lfps) in loops]}
+            for ((f, t, fps), loops) in zip(samples, iterations)]
+          json_list.append(entry)
+
+      solutions = self.executor.mapping['solutions']
+      if self.workers > 1:
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+          futures = [pool.submit(self.measure, sol) for sol in solutions]
+          for future in as_completed(futures):
+            record(*future.result())
+      else:
+        for sol in (self.executor.schedule(solutions) if self.device else solutions):
+          record(*self.measure(sol))
+        if self.device:
+          print(self.executor.programmingSummary(solutions))
+    finally:
+      if csv_fp != None:
+        csv_fp.close()
+      if json_list != None:
+        json_list.close()
+    return rows
+
+
+if __name__ == "__main__":
 
+  arg_parser = argparse.ArgumentParser(
+    "Measure the performance of every heterogeneous solution")
+  arg_parser.add_argument('partitions', type=str, metavar='DIR',
+    help='partitions directory, containing heterogeneous/hardware.json')
+  arg_parser.add_argument('-b', '--bin-pattern', type=str, metavar='STRING', required=True,
+    help='binary path pattern, @INDEX@ is substituted with the unique partition index, '
+    'e.g., unique_@INDEX@_3.3/bin/Top_RVC_Decoder')
+  arg_parser.add_argument('-a', '--args', type=str, default='',
+    help='arguments of the binary, e.g., "--i=foreman_qcif_30.bit --l=1"')
+  arg_parser.add_argument('-w', '--warmup', type=int, default=1,
+    help='unmeasured runs of every solution')
+  arg_parser.add_argument('-n', '--trials', type=int, default=5,
+    help='measured runs of every solution')
+  arg_parser.add_argument('-c', '--confidence', type=float, default=0.95,
+    help='confidence level of the fps interval')
+  arg_parser.add_argument('--csv', type=str, metavar='FILE', default='benchmark.csv',
+    help='csv result table')
+  arg_parser.add_argument('--json', type=str, metavar='FILE', default=None,
+    help='json result table, with the samples of every trial')
+  arg_parser.add_argument('-x', '--xclbin-pattern', type=str, metavar='STRING', default=None,
+    help='xclbin path pattern, @INDEX@ is substituted with the unique partition index. '
+    'The device is programmed with it before a solution runs, unless it is already loaded')
+  arg_parser.add_argument('--program-command', type=str, metavar='STRING',
+    default=PartitionExecutor.PROGRAM_COMMAND,
+    help='command programming the device, {xclbin} is substituted with the xclbin path')
+  arg_parser.add_argument('-t', '--timeout', type=float, metavar='SECONDS', default=None,
+    help='kill a run after SECONDS')
+  arg_parser.add_argument('--hang-timeout', type=float, metavar='SECONDS', default=None,
+    help='kill a run that prints nothing for SECONDS, the binaries are run '
+    'under stdbuf -oL so that their output is not held back by buffering')
+  arg_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+    help='print the throughput of every loop as it is measured')
+  arg_parser.add_argument('--no-device', action='store_true', default=False,
+    help='the binaries do not use the device (e.g., SystemC or software builds) '
+    'and may run concurrently')
+  arg_parser.add_argument('-j', '--workers', type=int, default=1,
+    help='solutions run concurrently with --no-device')
+  args = arg_parser.parse_args()
 
+  executor = PartitionExecutor(args.partitions, args.bin_pattern,
+    args.xclbin_pattern, args.program_command)
+  if args.hang_timeout != None and executor.stdbuf == None:
+    StreamblocksBuild.printError("stdbuf not found, the output of the binaries "
+      "is block buffered and --hang-timeout may kill runs that are not hung")
+  benchmark = PartitionBenchmark(executor, args.warmup, args.trials, args.args,
+    args.confidence, not args.no_device, args.workers,
+    timeout=args.timeout, hang_timeout=args.hang_timeout, verbose=args.verbose)
+  benchmark.run(args.csv, args.json)
@@ -1,14 +1,12 @@
 #!/usr/bin/env python3
 import json
 import re
-from zipfile import ZipFile
 import argparse
 import sys
 import os
 import inspect
+import functools
 import requests
-import shutil
-import tarfile
 
 try:
     from .. import StreamblocksBuild
@@ -30,67 +28,114 @@ class CustomJenkinsJob(StreamblocksBuild.JenkinsJob):
     def makeDirectory(path):
       StreamblocksBuild.Utilities.forceMakeDirectory(path)
 
-    def getReport(self, server, user, token):
+    # artifacts the reports are made of
+    REPORT_ARTIFACTS = [
+        '*/instance_reports.tar.gz',
+        '*/reports/report_utilization.rpt',
+        '*/reports/timing_summary.rpt'
+    ]
+
+    def getReport(self, server, user, token, full_archive=False, max_paths=None, slr=False,
+                  workers=None):
         """
         Downloads the job artifacts and extracst hls instance reports and
-        network synthesis and timing reports
+        network synthesis and timing reports. Only the artifacts needed by the
+        reports are downloaded, unless full_archive is set. The reports are
+        read straight from the artifacts, nothing is extracted. Only the
+        max_paths timing paths with the least slack are kept when max_paths
+        is given, and the per SLR utilization is added when slr is set. The
+        hls instance reports are summarized on workers processes (all cores
+        by default).
         """
-        self.download(server, user, token)
-
-        artifact_path = self.dir + '/artifacts.zip'
-        if not os.path.exists(artifact_path):
-            StreamblocksBuild.printError(
-                "Artifact file " + str(artifact_path) + " does not exist")
+        artifact_path = self.fetchReport(server, user, token, full_archive)
+        if artifact_path == None:
             return
-        extract_dir = os.path.abspath(self.dir) + '/extracted/'
-        CustomJenkinsJob.makeDirectory(extract_dir)
-
-        print("Extracting artifacts to " + extract_dir)
-        with ZipFile(artifact_path, 'r') as zfp:
-            zfp.extractall(extract_dir)
+        return CustomJenkinsJob.parseReport(artifact_path, max_paths, slr, workers)
 
-        instance_summary = CustomJenkinsJob.__get_instance_report__(
-            extract_dir)
-        network_summary = CustomJenkinsJob.__get_synthesis_report__(
-            extract_dir)
+    def fetchReport(self, server, user, token, full_archive=False):
+        """
+        Download the artifacts of the reports, returns the path of the
+        artifacts or None if they are not available
+        """
+        if full_archive:
+            self.download(server, user, token)
+
+            artifact_path = self.dir + '/artifacts.zip'
+            if not os.path.exists(artifact_path):
+                StreamblocksBuild.printError(
+                    "Artifact file " + str(artifact_path) + " does not exist")
+                return None
+        else:
+            self.download(server, user, token,
+                          CustomJenkinsJob.REPORT_ARTIFACTS)
+            artifact_path = os.path.abspath(self.dir) + '/artifacts/'
+            if not os.path.exists(artifact_path):
+                StreamblocksBuild.printError(
+                    "Artifacts directory " + artifact_path + " does not exist")
+                return None
+        return artifact_path
+
+    def parseReport(artifact_path, max_paths=None, slr=False, workers=None):
+        """
+        Build the report from the artifacts downloaded by fetchReport
+        """
+        with StreamblocksBuild.Artifacts(artifact_path) as artifacts:
+            instance_summary = CustomJenkinsJob.__get_instance_report__(
+                artifacts, workers)
+            network_summary = CustomJenkinsJob.__get_synthesis_report__(
+                artifacts, max_paths, slr)
         return {
             'network_synth': network_summary,
             'instance_synth': instance_summary
         }
 
   
-    def __get_synthesis_report__(extract_dir):
+    def __get_synthesis_report__(artifacts, max_paths=None, slr=False):
         """
         Get the resource and timing report in a dictionary
         """
-        timing_report_path = extract_dir + 'archive/project/bin/reports/timing_summary.rpt'
-        result = {'timing': None, 'utilization': None}
-        # if os.path.exists(timing_report_path):
-
-        utilization_report_path = extract_dir + \
-            'archive/project/bin/reports/report_utilization.rpt'
-        util_report = StreamblocksBuild.Utilities.__get_utilization_report__(
-            utilization_report_path)
-        timing_report = StreamblocksBuild.Utilities.__get_timing_report__(
-            timing_report_path)
+        def __read_report__(relative_path, parse, kind):
+            if not artifacts.exists(relative_path):
+                StreamblocksBuild.printError(
+                    kind + " " + artifacts.describe(relative_path) + " does not exist")
+                return None
+            with artifacts.openText(relative_path) as fp:
+                return parse(fp)
+
+        util_report = __read_report__(
+            'project/bin/reports/report_utilization.rpt',
+            lambda fp: StreamblocksBuild.Utilities.__get_utilization_report__(
+                fp, slr),
+            "Synthesis report")
+        def __parse_timing__(fp):
+            # the paths are listed per path group (clock), the worst paths of
+            # the design are not necessarily the first ones
+            report = StreamblocksBuild.TimingReport(fp)
+            if max_paths != None:
+                return (report.worst(max_paths), report.summary)
+            return (list(report.paths()), report.summary)
+
+        timing = __read_report__(
+            'project/bin/reports/timing_summary.rpt',
+            __parse_timing__,
+            "Timing report")
+        (timing_report, timing_summary) = timing if timing != None else (None, None)
         return {
             'utilization': util_report,
-            'timing': timing_report
+            'timing': timing_report,
+            'timing_summary': timing_summary
         }
 
-    def __get_instance_report__(extract_dir):
+    def __get_instance_report__(artifacts, workers=None):
 
-        instance_report_gz_path = extract_dir + 'archive/project/bin/instance_reports.tar.gz'
-        if not os.path.exists(instance_report_gz_path):
+        instance_report_gz_path = 'project/bin/instance_reports.tar.gz'
+        if not artifacts.exists(instance_report_gz_path):
             StreamblocksBuild.printError(
-                "Instance report file does not exist at " + str(instance_report_gz_path))
+                "Instance report file does not exist at " + artifacts.describe(instance_report_gz_path))
             return None
-        instance_tar = tarfile.open(instance_report_gz_path, 'r:gz')
-        instance_report_dir = extract_dir + '/instnace_reports'
-        CustomJenkinsJob.makeDirectory(instance_report_dir)
-        instance_tar.extractall(instance_report_dir)
-        hls_projects_root = instance_report_dir + '/build/vivado-hls'
-        return StreamblocksBuild.Utilities.__get_instance_report__(hls_projects_root)
+        with artifacts.open(instance_report_gz_path) as instance_fp:
+            return StreamblocksBuild.Utilities.__get_instance_report_archive__(
+                instance_fp, 'build/vivado-hls', workers)
         
 
 if __name__ == "__main__":
@@ -99,46 +144,92 @@ if __name__ == "__main__":
         "Summarize the hls reports of jobs into json files"
     )
     arg_parser.add_argument('jobs', type=str, metavar='FILE',
-                            help='json build jobss configuration file')
+                            help='json build jobss configuration file, or a .jsonl stream of jobs')
     # arg_parser.add_argument('--no-download', '-n', action='store_true',
     #                         help='do not download build artifacts if they do not exist', default=False)
     arg_parser.add_argument('-s', '--server', type=str, metavar='URL',
                             help='jenkins server address url', default=StreamblocksBuild.JenkinsJob.DEFAULT_SERVER)
 
+    arg_parser.add_argument('--full-archive', '-F', action='store_true', default=False,
+                            help='download the whole artifact archive instead of the report artifacts only')
+    arg_parser.add_argument('--max-paths', '-p', type=int, metavar='N', default=None,
+                            help='keep only the N timing paths with the least slack of each report, across all path groups')
+    arg_parser.add_argument('--slr', action='store_true', default=False,
+                            help='add the per SLR utilization of multi SLR devices')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None,
+                            help='processes parsing the reports, all cores by default')
+    arg_parser.add_argument('-d', '--downloads', type=int, default=4,
+                            help='number of jobs whose artifacts are downloaded concurrently')
     arg_parser.add_argument('--single-file', '-S', action='store_true',
                             help='save all the summaries in a single file', default=False)
     arg_parser.add_argument('--output', '-o', type=str, metavar='FILE',
                             help='output file name if --single-file or -S is provided', default='summary.json')
     args = arg_parser.parse_args()
 
-    with open(args.jobs, 'r') as jobs_fp:
-        print('Reading job file')
-        jobs_desc = json.load(jobs_fp)
-
-        print('Username: ' + jobs_desc['username'])
-
-        jenkins_url = args.server
-        jenkins_server = \
-            StreamblocksBuild.JenkinsJob.getServer(jenkins_url,
-                                                   username=jobs_desc['username'], password=jobs_desc['token'])
-
-        user = jobs_desc['username']
-        token = jobs_desc['token']
-        all_summaries = []
-        for job_info in jobs_desc['jobs']:
-            summary = CustomJenkinsJob(job_info, no_prompt=False).getReport(
-                jenkins_server, user, token)
-            if not args.single_file:
-                summary_path = job_info['dir'] + '/instance_report.json'
-                job_info['artifacts'] = summary
-                with open(summary_path, 'w') as fp:
-                    fp.write(json.dumps(job_info, indent=4))
-            else:
-                all_summaries.append(job_info)
-
-        if args.single_file:
-            with open(args.output, 'w') as fp:
-                fp.write(json.dumps(all_summaries, indent=4))
-
-        print("All done. Visit %sjob/%s to query the status of your jobs." %
-              (jenkins_url, user))
+    print('Reading job file')
+    jobs_desc = StreamblocksBuild.JobsFile(args.jobs)
+
+    print('Username: ' + jobs_desc['username'])
+
+    jenkins_url = args.server
+    jenkins_server = \
+        StreamblocksBuild.JenkinsJob.getServer(jenkins_url,
+                                               username=jobs_desc['username'], password=jobs_desc['token'])
+
+    user = jobs_desc['username']
+    token = jobs_desc['token']
+    StreamblocksBuild.JenkinsJob.snapshot = \
+        StreamblocksBuild.JobSnapshot(jenkins_server, user)
+    StreamblocksBuild.JenkinsJob.download_manager = \
+        StreamblocksBuild.DownloadManager(user, token)
+    include = None if args.full_archive else CustomJenkinsJob.REPORT_ARTIFACTS
+    # all the prompts are answered first, then the jobs are pulled from the
+    # job file as the aggregator needs them, only the jobs in flight are kept
+    answers = jobs_desc.resolvePrompts(
+        lambda job_info: CustomJenkinsJob(job_info, no_prompt=False),
+        lambda job: job.resolveDownloadPrompts(include))
+    job_infos = {}
+
+    def reportJobs():
+        for job_info in jobs_desc.jobs():
+            job = CustomJenkinsJob(job_info, no_prompt=False)
+            job.useAnswers(answers.get(job.name, {}))
+            job_infos[job] = job_info
+            yield job
+
+    # a single job parses its instance reports on all the workers, many
+    # jobs (or a stream of jobs) are parsed concurrently with one process each
+    single_job = jobs_desc.count == 1
+    parse = functools.partial(CustomJenkinsJob.parseReport, max_paths=args.max_paths,
+                              slr=args.slr, workers=args.workers if single_job else 1)
+    aggregator = StreamblocksBuild.ReportAggregator(
+        lambda: StreamblocksBuild.JenkinsJob.getServer(jenkins_url, username=user, password=token),
+        user, args.downloads, 1 if single_job else args.workers)
+
+    single_file = StreamblocksBuild.JsonListWriter(args.output) \
+        if args.single_file else None
+
+    def done(job, summary, error):
+        job_info = job_infos.pop(job)
+        job_info['artifacts'] = summary
+        if error != None:
+            job_info['error'] = error
+        if not args.single_file:
+            summary_path = job_info['dir'] + '/instance_report.json'
+            with open(summary_path, 'w') as fp:
+                fp.write(json.dumps(job_info, indent=4))
+        else:
+            single_file.append(job_info)
+
+    try:
+        failed = aggregator.run(reportJobs(),
+                                lambda job, server: job.fetchReport(
+                                    server, user, token, args.full_archive),
+                                parse, done)
+    finally:
+        if single_file != None:
+            single_file.close()
+    print("Reported %d of %d jobs" % (aggregator.finished - failed, aggregator.finished))
+
+    print("All done. Visit %sjob/%s to query the status of your jobs." %
+          (jenkins_url, user))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import inspect
+import io
+import re
+import time
+
+try:
+    from .. import StreamblocksBuild
+except ImportError as e:
+    currentdir = os.path.dirname(os.path.abspath(
+        inspect.getfile(inspect.currentframe())))
+    parentdir = os.path.dirname(currentdir)
+    sys.path.insert(0, parentdir)
+    import StreamblocksBuild
+
+
+"""
+Time the utilization report parser over a corpus of report_utilization.rpt
+files against the previous parser, that compiled its expressions on every
+call and tried all of them on every line
+"""
+
+
+def legacyUtilization(util_fp):
+    """
+    The parser UtilizationReport replaces, kept as the baseline
+    """
+    def getUtilRE(resource):
+        return re.compile(r'\|\s*' + resource + r'\s*\|\s*(\d*)(\.\d*)?\s*\|\s*\d*\s*\|\s*(\d*)\s*\|\s*(\d*\.\d*)\s*\|')
+
+    report_fields = {
+        'LUTS': 'CLB LUTs\*',
+        'FF': 'CLB Registers',
+        'BRAM': 'Block RAM Tile',
+        'DSP': 'DSPs'
+    }
+    util_sum = dict((k, None) for k in report_fields.keys())
+    expression_map = dict((k, getUtilRE(v)) for (k, v) in report_fields.items())
+    for line in util_fp.readlines():
+        for rs, expr in expression_map.items():
+            matches = expr.match(line)
+            if matches != None:
+                util_sum[rs] = {"used": int(matches.group(1)),
+                                "availble": int(matches.group(3)),
+                                "util": float(matches.group(4))}
+    return util_sum
+
+
+def findReports(paths):
+    reports = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (root, dirs, files) in os.walk(path):
+                reports += [os.path.join(root, f) for f in sorted(files)
+                            if f.startswith('report_utilization') and f.endswith('.rpt')]
+        else:
+            reports.append(path)
+    return reports
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        "Benchmark the utilization report parser")
+    arg_parser.add_argument('reports', type=str, metavar='PATH', nargs='+',
+                            help='utilization reports, or directories searched for report_utilization*.rpt')
+    arg_parser.add_argument('--repeat', '-r', type=int, default=5,
+                            help='number of times each parser is run, the best time is reported')
+    arg_parser.add_argument('--slr', action='store_true', default=False,
+                            help='also parse the per SLR tables')
+    args = arg_parser.parse_args()
+
+    reports = findReports(args.reports)
+    if len(reports) == 0:
+        StreamblocksBuild.printError("No utilization report found")
+        sys.exit(1)
+
+    # reports are parsed from memory so that disk reads do not get in the
+    # measurements
+    corpus = []
+    for path in reports:
+        with open(path, 'r') as fp:
+            corpus.append((path, fp.read()))
+    corpus_size = sum(len(text) for (_, text) in corpus)
+    print("%d reports, %.2f MB" % (len(corpus), corpus_size / 1e6))
+
+    parsers = [
+        ('legacy', legacyUtilization),
+        ('one-pass', lambda fp: StreamblocksBuild.UtilizationReport(
+            fp, args.slr).parse())
+    ]
+
+    results = {}
+    for (name, parse) in parsers:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs = [parse(io.StringIO(text)) for (_, text) in corpus]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best == None else min(best, elapsed)
+        results[name] = outputs
+        print("%-10s %10.2f ms %10.2f MB/s" %
+              (name, best * 1e3, corpus_size / max(best, 1e-9) / 1e6))
+
+    # the legacy parser keeps the last matching row, so the per SLR table of
+    # multi SLR devices overrides the device totals, report the differences
+    for (index, (path, _)) in enumerate(corpus):
+        legacy = results['legacy'][index]
+        current = results['one-pass'][index]
+        for key in legacy.keys():
+            if legacy[key] != None and legacy[key] != current[key]:
+                print("%s: %s legacy %s, one-pass %s" %
+                      (path, key, legacy[key], current[key]))
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 import json
-from zipfile import ZipFile
 import argparse
 import sys
 import os
 import inspect
+import functools
 
 
 try:
@@ -16,7 +16,12 @@ except ImportError as e:
     sys.path.insert(0, parentdir)
     import StreamblocksBuild
 
-from xml.dom import minidom
+from xml.etree import ElementTree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 """
@@ -65,104 +70,260 @@ class SystemCJob(StreamblocksBuild.JenkinsJob):
     def makeDirectory(path):
         StreamblocksBuild.Utilities.forceMakeDirectory(path)
 
-    def getReport(self, server, runs, user, token):
+    def getReport(self, server, runs, user, token, full_archive=False):
         """
-        Downloads the job artifacts and extract systemc profile information
-       
+        Downloads the job artifacts and extract systemc profile information.
+        Only the profiles of the runs are downloaded, unless full_archive is
+        set.
         """
-        self.download(server, user, token)
+        artifact_path = self.fetchReport(server, runs, user, token, full_archive)
+        if artifact_path == None:
+            return
+        return SystemCJob.parseReport(artifact_path, runs)
 
-        artifact_path = self.dir + '/artifacts.zip'
+    def runArtifacts(runs):
+        return ['*/' + r + '/' + r + '.exdf' for r in runs]
 
-        if not os.path.exists(artifact_path):
-            StreamblocksBuild.printError(
-                "Artifact file " + str(artifact_path) + " does not exist")
-            return
-        extract_dir = os.path.abspath(self.dir) + '/extracted/'
-        SystemCJob.makeDirectory(extract_dir)
+    def fetchReport(self, server, runs, user, token, full_archive=False):
+        """
+        Download the profiles of the runs, returns the path of the artifacts
+        or None if they are not available
+        """
+        if full_archive:
+            self.download(server, user, token)
 
-        print("Extracting artifacts to " + extract_dir)
-        with ZipFile(artifact_path, 'r') as zfp:
-            zfp.extractall(extract_dir)
+            artifact_path = self.dir + '/artifacts.zip'
 
-        return [
-            {'run_name': r, 'profile': SystemCJob.__get_run_profile__(r, extract_dir)} for r in runs
-        ]
+            if not os.path.exists(artifact_path):
+                StreamblocksBuild.printError(
+                    "Artifact file " + str(artifact_path) + " does not exist")
+                return None
+        else:
+            self.download(server, user, token, SystemCJob.runArtifacts(runs))
+            artifact_path = os.path.abspath(self.dir) + '/artifacts/'
+        return artifact_path
 
-    def __get_run_profile__(run, extract_dir):
+    def parseReport(artifact_path, runs):
+        """
+        Build the profiles of the runs from the artifacts downloaded by
+        fetchReport
+        """
+        with StreamblocksBuild.Artifacts(artifact_path) as artifacts:
+            return [
+                {'run_name': r, 'profile': SystemCJob.__get_run_profile__(r, artifacts)} for r in runs
+            ]
 
-        bin_dir = extract_dir + '/archive/project/bin/' + run
+    def __get_run_profile__(run, artifacts):
 
-        if not os.path.exists(bin_dir):
+        bin_dir = 'project/bin/' + run
+
+        if not artifacts.exists(bin_dir):
             StreamblocksBuild.printError(
-                "Run %s does not exists at %s" % (run, bin_dir))
+                "Run %s does not exists at %s" % (run, artifacts.describe(bin_dir)))
             return None
 
         exdf_path = bin_dir + "/" + run + ".exdf"
 
-        if not os.path.exists(exdf_path):
+        if not artifacts.exists(exdf_path):
             StreamblocksBuild.printError(
-                "Can not open exdf file at %s" % exdf_path)
+                "Can not open exdf file at %s" % artifacts.describe(exdf_path))
             return None
 
-        exdf_profile = minidom.parse(exdf_path)
+        with artifacts.open(exdf_path) as exdf_fp:
+            return SystemCJob.__parse_profile__(exdf_fp)
 
-        all_actor_elements = exdf_profile.getElementsByTagName('actor')
+    TRIGGER_STATES = ["IDLE_STATE", "LAUNCH", "CHECK", "SLEEP",
+                      "SYNC_LAUNCH", "SYNC_CHECK", "SYNC_WAIT", "SYNC_EXEC"]
 
-        valid_actor_elements = list(filter(
-            lambda e: e.attributes['id'].value.find('fanout') == -1,
-            all_actor_elements
-        ))
+    def __parse_profile__(exdf_fp):
+        """
+        Parse an exdf profile in a single pass of iterparse events. Each actor
+        element is cleared and detached from the tree once its record is
+        built, and so is every other element outside of actors (connections,
+        ...) once it ends, so only one actor is held in memory at a time.
+        """
+        network = None
+        actors = []
+        actor = None
+        parents = []
+
+        for (event, elem) in ElementTree.iterparse(exdf_fp, events=('start', 'end')):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                parents.append(elem)
+                if tag == 'network' and network == None:
+                    network = dict(elem.attrib)
+                elif tag == 'actor' and actor == None:
+                    actor = {'elem': elem, 'actions': [], 'trigger': None}
+                continue
+
+            parents.pop()
+            if actor == None:
+                # nothing is read from elements outside of actors at their end
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+                continue
+            if tag == 'action':
+                actor['actions'].append({
+                    'id': elem.attrib['id'],
+                    'mean_cycles': float(elem.attrib['clockcycles']),
+                    'max_cycles': int(elem.attrib['clockcycles-min']),
+                    'min_cycles': int(elem.attrib['clockcycles-max']),
+                    'total_cycles': int(elem.attrib['clockcycles-total']),
+                    'firings': int(elem.attrib['firings'])
+                })
+            elif tag == 'trigger' and actor['trigger'] == None:
+                actor['trigger'] = dict(
+                    (state, int(elem.attrib[state])) for state in SystemCJob.TRIGGER_STATES)
+            elif elem is actor['elem']:
+                id = elem.attrib['id']
+                if id.find('fanout') == -1:
+                    actors.append({
+                        'id': id,
+                        'total_cycles': int(elem.attrib['clockcycles-total']),
+                        'firings': int(elem.attrib['firings']),
+                        'actions': actor['actions'],
+                        'trigger': actor['trigger']
+                    })
+                actor = None
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+
+        if network == None:
+            StreamblocksBuild.printError("No network in exdf profile")
+            return None
 
-        def parseActorStats(actor_elem):
-            id = actor_elem.attributes["id"].value
-            total_cycles = int(
-                actor_elem.attributes["clockcycles-total"].value)
-            firings = int(actor_elem.attributes["firings"].value)
-            action_elems = actor_elem.getElementsByTagName('action')
+        return {
+            'name': network['name'],
+            'total_cycles': int(network['clockcycles-total']),
+            'trip_count': int(network['runs']),
+            'actors': actors
+        }
 
-            actions = [{
-                'id': e.attributes['id'].value,
-                'mean_cycles': float(e.attributes['clockcycles'].value),
-                'max_cycles': int(e.attributes['clockcycles-min'].value),
-                'min_cycles': int(e.attributes['clockcycles-max'].value),
-                'total_cycles': int(e.attributes['clockcycles-total'].value),
-                'firings': int(e.attributes['firings'].value)
-            } for e in action_elems]
 
-            triggerElement = actor_elem.getElementsByTagName("trigger")[0]
+class ProfileStore:
 
-            trigger = {
-                "IDLE_STATE": int(triggerElement.attributes["IDLE_STATE"].value),
-                "LAUNCH": int(triggerElement.attributes["LAUNCH"].value),
-                "CHECK": int(triggerElement.attributes["CHECK"].value),
-                "SLEEP": int(triggerElement.attributes["SLEEP"].value),
-                "SYNC_LAUNCH": int(triggerElement.attributes["SYNC_LAUNCH"].value),
-                "SYNC_CHECK": int(triggerElement.attributes["SYNC_CHECK"].value),
-                "SYNC_WAIT": int(triggerElement.attributes["SYNC_WAIT"].value),
-                "SYNC_EXEC": int(triggerElement.attributes["SYNC_EXEC"].value)
-            }
+    """
+    Columnar store of run profiles (requires numpy). Every run is kept as a
+    struct of arrays: one entry per actor for the ids, cycles, firings and a
+    matrix of the trigger counters, and the actions of all the actors as one
+    flat table, actor i owning the rows action_offsets[i] to
+    action_offsets[i + 1]. Stores are saved to and loaded from npz files and
+    can be exported back to the json profiles.
+    """
 
-            return {
-                'id': id,
-                'total_cycles': total_cycles,
-                'firings': firings,
-                'actions': actions,
-                'trigger': trigger
-            }
+    ACTION_COLUMNS = [('mean_cycles', float), ('max_cycles', int),
+                      ('min_cycles', int), ('total_cycles', int), ('firings', int)]
+
+    def __init__(self):
+        if numpy == None:
+            raise RuntimeError("the profile store requires numpy")
+        self.runs = {}
 
-        actors = [parseActorStats(e) for e in valid_actor_elements]
-        network_elem = exdf_profile.getElementsByTagName('network')[0]
-        total_cycles = int(network_elem.attributes['clockcycles-total'].value)
-        trip_count = int(network_elem.attributes['runs'].value)
+    def __len__(self):
+        return len(self.runs)
 
+    def keys(self):
+        return list(self.runs.keys())
+
+    def add(self, key, profile):
+        """
+        Add the profile returned by SystemCJob.__get_run_profile__ as key
+        """
+        actors = profile['actors']
+        actions = [a for actor in actors for a in actor['actions']]
+        run = {
+            'name': numpy.array(profile['name']),
+            'total_cycles': numpy.array(profile['total_cycles'], dtype=numpy.int64),
+            'trip_count': numpy.array(profile['trip_count'], dtype=numpy.int64),
+            'actor_ids': numpy.array([a['id'] for a in actors], dtype=str),
+            'actor_total_cycles': numpy.array([a['total_cycles'] for a in actors], dtype=numpy.int64),
+            'actor_firings': numpy.array([a['firings'] for a in actors], dtype=numpy.int64),
+            'trigger': numpy.array(
+                [[a['trigger'][s] for s in SystemCJob.TRIGGER_STATES] for a in actors],
+                dtype=numpy.int64).reshape(len(actors), len(SystemCJob.TRIGGER_STATES)),
+            'action_offsets': numpy.cumsum(
+                [0] + [len(a['actions']) for a in actors], dtype=numpy.int64),
+            'action_ids': numpy.array([a['id'] for a in actions], dtype=str)
+        }
+        for (column, kind) in ProfileStore.ACTION_COLUMNS:
+            run['action_' + column] = numpy.array(
+                [a[column] for a in actions],
+                dtype=numpy.float64 if kind == float else numpy.int64)
+        self.runs[key] = run
+
+    def save(self, path):
+        arrays = {}
+        for (key, run) in self.runs.items():
+            for (column, values) in run.items():
+                arrays[key + '/' + column] = values
+        numpy.savez_compressed(path, **arrays)
+
+    def load(path):
+        store = ProfileStore()
+        with numpy.load(path, allow_pickle=False) as npz:
+            for name in npz.files:
+                (key, column) = name.rsplit('/', 1)
+                store.runs.setdefault(key, {})[column] = npz[name]
+        return store
+
+    def profile(self, key):
+        """
+        The profile of key as returned by SystemCJob.__get_run_profile__
+        """
+        run = self.runs[key]
+        offsets = run['action_offsets']
+        columns = [(c, kind, run['action_' + c]) for (c, kind) in ProfileStore.ACTION_COLUMNS]
+        actors = []
+        for (i, id) in enumerate(run['actor_ids']):
+            actions = []
+            for j in range(offsets[i], offsets[i + 1]):
+                action = {'id': str(run['action_ids'][j])}
+                for (column, kind, values) in columns:
+                    action[column] = kind(values[j])
+                actions.append(action)
+            actors.append({
+                'id': str(id),
+                'total_cycles': int(run['actor_total_cycles'][i]),
+                'firings': int(run['actor_firings'][i]),
+                'actions': actions,
+                'trigger': dict(zip(SystemCJob.TRIGGER_STATES,
+                                    [int(c) for c in run['trigger'][i]]))
+            })
         return {
-            'name': network_elem.attributes['name'].value,
-            'total_cycles': total_cycles,
-            'trip_count': trip_count,
+            'name': str(run['name']),
+            'total_cycles': int(run['total_cycles']),
+            'trip_count': int(run['trip_count']),
             'actors': actors
         }
 
+    def export(self):
+        """
+        All the profiles as the run lists of the json summaries
+        """
+        return [{'run_name': key, 'profile': self.profile(key)} for key in self.keys()]
+
+    def topActors(self, key, state='SYNC_WAIT', n=10):
+        """
+        The n actors of key with the largest share of state among their
+        trigger counters, as a list of (actor id, share) pairs
+        """
+        run = self.runs[key]
+        trigger = run['trigger']
+        totals = trigger.sum(axis=1)
+        share = numpy.divide(trigger[:, SystemCJob.TRIGGER_STATES.index(state)], totals,
+                             out=numpy.zeros(len(totals)), where=totals > 0)
+        order = numpy.argsort(-share, kind='stable')[:n]
+        return [(str(run['actor_ids'][i]), float(share[i])) for i in order]
+
+    def printTop(self, state='SYNC_WAIT', n=10, prefix=''):
+        for key in self.keys():
+            print("Top %s actors of %s%s:" % (state, prefix, key))
+            for (actor, share) in self.topActors(key, state, n):
+                print("  %-40s %6.2f%%" % (actor, share * 100))
+
 
 if __name__ == "__main__":
 
@@ -170,49 +331,119 @@ if __name__ == "__main__":
         "Summarize systemc simulation profiles of jobs into json files"
     )
     arg_parser.add_argument('jobs', type=str, metavar='FILE',
-                            help='json build jobss configuration file')
+                            help='json build jobss configuration file, or a .jsonl stream of jobs')
     
     arg_parser.add_argument('-s', '--server', type=str, metavar='URL',
                             help='jenkins server address url', default=StreamblocksBuild.JenkinsJob.DEFAULT_SERVER)
     arg_parser.add_argument('--runs', '-r', nargs='+', required=True,
                             help="REQUIRED List of run names, e.g, -r bust_cif_15 foreman_qqcif_30")
+    arg_parser.add_argument('--full-archive', '-F', action='store_true', default=False,
+                            help='download the whole artifact archive instead of the run profiles only')
     arg_parser.add_argument('--single-file', '-S', action='store_true',
                             help='save all the summaries in a single file', default=False)
     arg_parser.add_argument('--output', '-o', type=str, metavar='FILE',
                             help='output file name if --single-file or -S is provided', default='summary.json')
+    arg_parser.add_argument('--format', '-f', choices=['json', 'npz', 'both'], default='json',
+                            help='summary format, npz is the columnar profile store and requires numpy')
+    arg_parser.add_argument('--top', '-t', type=int, metavar='N', default=0,
+                            help='print the N actors of every run with the largest share of --top-state, requires numpy')
+    arg_parser.add_argument('--top-state', choices=SystemCJob.TRIGGER_STATES, default='SYNC_WAIT',
+                            help='trigger state the actors are ranked by with --top')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None,
+                            help='processes parsing the profiles, all cores by default')
+    arg_parser.add_argument('-d', '--downloads', type=int, default=4,
+                            help='number of jobs whose artifacts are downloaded concurrently')
     arg_parser.add_argument('-y', '--no-prompt', action='store_true', default=False, help="do not prompt")
     args = arg_parser.parse_args()
 
-    with open(args.jobs, 'r') as jobs_fp:
-        print('Reading job file')
-        jobs_desc = json.load(jobs_fp)
-
-        print('Username: ' + jobs_desc['username'])
-
-        jenkins_url = args.server
-        jenkins_server = \
-            StreamblocksBuild.JenkinsJob.getServer(jenkins_url,
-                                                   username=jobs_desc['username'], password=jobs_desc['token'])
-
-        user = jobs_desc['username']
-        token = jobs_desc['token']
-        all_summaries = []
-        for job_info in jobs_desc['jobs']:
-            summary = SystemCJob(job_info, no_prompt=args.no_prompt).getReport(
-                jenkins_server, args.runs, user, token)
-            
-            job_info['artifacts'] = summary
-            if not args.single_file:
+    columnar = args.format != 'json' or args.top > 0
+    if columnar and numpy == None:
+        StreamblocksBuild.printError(
+            "numpy is required by --format %s and --top" % args.format)
+        sys.exit(1)
+    write_json = args.format != 'npz'
+    write_npz = args.format != 'json'
+
+    print('Reading job file')
+    jobs_desc = StreamblocksBuild.JobsFile(args.jobs)
+
+    print('Username: ' + jobs_desc['username'])
+
+    jenkins_url = args.server
+    jenkins_server = \
+        StreamblocksBuild.JenkinsJob.getServer(jenkins_url,
+                                               username=jobs_desc['username'], password=jobs_desc['token'])
+
+    user = jobs_desc['username']
+    token = jobs_desc['token']
+    StreamblocksBuild.JenkinsJob.snapshot = \
+        StreamblocksBuild.JobSnapshot(jenkins_server, user)
+    StreamblocksBuild.JenkinsJob.download_manager = \
+        StreamblocksBuild.DownloadManager(user, token)
+    include = None if args.full_archive else SystemCJob.runArtifacts(args.runs)
+    # all the prompts are answered first, then the jobs are pulled from the
+    # job file as the aggregator needs them, only the jobs in flight are kept
+    answers = jobs_desc.resolvePrompts(
+        lambda job_info: SystemCJob(job_info, no_prompt=args.no_prompt),
+        lambda job: job.resolveDownloadPrompts(include))
+    job_infos = {}
+
+    def reportJobs():
+        for job_info in jobs_desc.jobs():
+            job = SystemCJob(job_info, no_prompt=args.no_prompt)
+            job.useAnswers(answers.get(job.name, {}))
+            job_infos[job] = job_info
+            yield job
+
+    aggregator = StreamblocksBuild.ReportAggregator(
+        lambda: StreamblocksBuild.JenkinsJob.getServer(jenkins_url, username=user, password=token),
+        user, args.downloads, args.workers)
+
+    all_store = ProfileStore() if columnar and args.single_file else None
+    single_file = StreamblocksBuild.JsonListWriter(args.output) \
+        if args.single_file and write_json else None
+
+    def done(job, summary, error):
+        job_info = job_infos.pop(job)
+        job_info['artifacts'] = summary
+        if error != None:
+            job_info['error'] = error
+        store = None
+        if columnar:
+            store = all_store if args.single_file else ProfileStore()
+            for run in (summary or []):
+                if run['profile'] != None:
+                    key = job_info['name'] + '/' + run['run_name'] \
+                        if args.single_file else run['run_name']
+                    store.add(key, run['profile'])
+        if not args.single_file:
+            if write_json:
                 summary_path = job_info['dir'] + '/profile_summary.json'
                 with open(summary_path, 'w') as fp:
                     fp.write(json.dumps(job_info, indent=4))
-            else:
-                
-                all_summaries.append(job_info)
-
-        if args.single_file:
-            with open(args.output, 'w') as fp:
-                fp.write(json.dumps(all_summaries, indent=4))
-
-        print("All done. Visit %sjob/%s to query the status of your jobs." %
-              (jenkins_url, user))
+            if write_npz:
+                store.save(job_info['dir'] + '/profile_summary.npz')
+        elif single_file != None:
+            single_file.append(job_info)
+        if args.top > 0 and not args.single_file:
+            store.printTop(args.top_state, args.top, job_info['name'] + '/')
+
+    try:
+        failed = aggregator.run(reportJobs(),
+                                lambda job, server: job.fetchReport(
+                                    server, args.runs, user, token, args.full_archive),
+                                functools.partial(SystemCJob.parseReport, runs=args.runs),
+                                done)
+    finally:
+        if single_file != None:
+            single_file.close()
+    print("Reported %d of %d jobs" % (aggregator.finished - failed, aggregator.finished))
+
+    if args.single_file:
+        if write_npz:
+            all_store.save(os.path.splitext(args.output)[0] + '.npz')
+        if args.top > 0:
+            all_store.printTop(args.top_state, args.top)
+
+    print("All done. Visit %sjob/%s to query the status of your jobs." %
+          (jenkins_url, user))
@@ -1,7 +1,67 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import json
+import re
+
+
+def parseAxis(axis):
+    """
+    Parse a sweep axis KEY=V1,V2,... or KEY=START:END (an inclusive range of
+    integers), returns the pair (KEY, values)
+    """
+    if not '=' in axis:
+        raise argparse.ArgumentTypeError(
+            "invalid axis %s, expected KEY=V1,V2,... or KEY=START:END" % axis)
+    (key, values) = axis.split('=', 1)
+    if re.fullmatch(r'-?\d+:-?\d+', values):
+        (start, end) = values.split(':')
+        return (key, range(int(start), int(end) + 1))
+    return (key, values.split(','))
+
+
+def paramValue(value, previous):
+    """
+    Value of a job parameter set by a sweep axis, numbers stay numbers unless
+    the base job already has the parameter as a string
+    """
+    if isinstance(previous, str):
+        return str(value)
+    for number in [int, float]:
+        try:
+            return number(value)
+        except ValueError:
+            pass
+    return value
+
+
+def sweep(jobs, axes, operation):
+    """
+    Generator of the jobs of the cartesian product of the sweep axes, for
+    every base job. axes is a list of (KEY, values) pairs, the @KEY@
+    substrings of the name, dir and network of the job are replaced by the
+    values of every axis. The INDEX axis only does the substitution, the CLOCK
+    axis also sets the HLS_CLOCK_PERIOD and KERNEL_FREQ parameters and any
+    other axis also sets the KEY parameter.
+    """
+    keys = [key for (key, _) in axes]
+    for job in jobs:
+        for point in itertools.product(*[values for (_, values) in axes]):
+            new_job = job.copy()
+            new_job['params'] = job['params'].copy()
+            for (key, value) in zip(keys, point):
+                for field in ['name', 'dir', 'network']:
+                    new_job[field] = new_job[field].replace(
+                        "@" + key + "@", str(value))
+                if key == 'CLOCK':
+                    new_job['params']['HLS_CLOCK_PERIOD'] = float(value)
+                    new_job['params']['KERNEL_FREQ'] = int(1000. / float(value))
+                elif key != 'INDEX':
+                    new_job['params'][key] = paramValue(
+                        value, job['params'].get(key))
+            new_job['operation'] = operation
+            yield new_job
 
 
 if __name__ == "__main__":
@@ -11,47 +71,60 @@ if __name__ == "__main__":
   An example job template job descritption can have name, dir, and network
   fields containing @INDEX@ substring that will be replaced
   by indices that is defined by the --start and --end switches.
+  Any other job parameter can be swept with --axis, e.g.,
+  --axis PLATFORM=xilinx_u250_xdma_201830_2,xilinx_u280_xdma_201920_3
+  sets the PLATFORM parameter and replaces @PLATFORM@, every combination of
+  the axes makes a job. The name must hold the @KEY@ of every axis with more
+  than one value, so that the jobs get distinct names.
   """)
     args_parser.add_argument(
         'jobs', type=str, metavar='FILE', help='json build job base configuration file')
     args_parser.add_argument('--start', metavar="n",
-                             type=int, help="start post-fix", required=True)
+                             type=int, help="start post-fix", default=None)
     args_parser.add_argument('--end', metavar="N",
-                             type=int, help='end post-fix', required=True)
+                             type=int, help='end post-fix', default=None)
     args_parser.add_argument('--output', metavar="FILE",
-                             type=str, help="outptut file", default='enumerated.json')
+                             type=str, help="outptut file, a .jsonl file is written one job per line as jobs are enumerated", default='enumerated.json')
     args_parser.add_argument('--operation', metavar="OP", type=str, choices=['build', 'clean', 'query', 'download'],
                              help='type of operation, overrides existing', default='build')
     args_parser.add_argument('--clocks', nargs='+', default=['3.3'])
+    args_parser.add_argument('--axis', metavar="KEY=VALUES", type=parseAxis, action='append', default=[],
+                             help='sweep the KEY parameter over comma separated values, or over START:END integers, can be repeated')
     args = args_parser.parse_args()
 
+    if (args.start == None) != (args.end == None):
+        args_parser.error("--start and --end go together")
+
+    axes = []
+    if args.start != None:
+        axes.append(('INDEX', range(args.start, args.end + 1, 1)))
+    axes.append(('CLOCK', args.clocks))
+    axes += args.axis
+
     with open(args.jobs, 'r') as build_config_file:
 
         print("Reading build config:")
         build_config = json.load(build_config_file)
 
-        user = build_config['username']
-        token = build_config['token']
-        jobs_desc = []
-        for job in build_config['jobs']:
-            for i in range(args.start, args.end + 1, 1):
-                for clk in args.clocks:
-                    new_job = job.copy()
-                    new_job['name'] = new_job['name'].replace("@INDEX@", str(i))
-                    new_job['name'] = new_job['name'].replace("@CLOCK@", str(clk))
-                    new_job['dir'] = new_job['dir'].replace("@INDEX@", str(i))
-                    new_job['dir'] = new_job['dir'].replace("@CLOCK@", str(clk))
-                    new_job['network'] = new_job['network'].replace(
-                        "@INDEX@", str(i))
-                    new_job['network'] = new_job['network'].replace(
-                        "@CLOCK@", str(clk))
-                    new_job['params'] = job['params'].copy()
-                    new_job['params']['HLS_CLOCK_PERIOD'] = float(clk)
-                    new_job['params']['KERNEL_FREQ'] = int(1000. / float(clk))
-                    new_job['operation'] = args.operation
-                    
-                    jobs_desc.append(new_job)
-
-        build_config['jobs'] = jobs_desc
-        with open(args.output, 'w') as output_file:
+    # every point of the sweep must get its own job name, or the jobs
+    # overwrite each other on the server, the directory may be shared
+    for job in build_config['jobs']:
+        for (key, values) in axes:
+            if len(values) > 1 and not "@" + key + "@" in job['name']:
+                args_parser.error("job %s sweeps %s over %d values but its name has no @%s@" % (
+                    job['name'], key, len(values), key))
+
+    jobs = sweep(build_config.pop('jobs'), axes, args.operation)
+    count = 0
+    with open(args.output, 'w') as output_file:
+        if args.output.endswith('.jsonl'):
+            # the description first, then one job per line
+            output_file.write(json.dumps(build_config) + '\n')
+            for job in jobs:
+                output_file.write(json.dumps(job) + '\n')
+                count += 1
+        else:
+            build_config['jobs'] = list(jobs)
+            count = len(build_config['jobs'])
             output_file.write(json.dumps(build_config, indent=4))
+    print("Enumerated %d jobs into %s" % (count, args.output))
@@ -26,7 +26,7 @@ else
 	info "NETWORK_NAME = ${NETWORK_NAME}"
 fi
 
-tar -xzf submission_file -C project
+tar -xf submission_file -C project
 info "Submission extracted"
 mkdir -p project/build
 cd project/build
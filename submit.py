@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-from StreamblocksBuild import JenkinsJob
-import json
+from StreamblocksBuild import JenkinsJob, JobsFile, SubmissionPool, TemplateCache, ArchiveCache, SubmissionUploader, Compression, JobSnapshot, StatusDashboard, ConsoleTail, DownloadManager, printError
+import itertools
+import sys
 
 if __name__ == "__main__":
 
@@ -10,31 +11,119 @@ if __name__ == "__main__":
     args_parser = argparse.ArgumentParser(
         description="Submit streamblocks generated code to build server")
     args_parser.add_argument(
-        'jobs', type=str, metavar='FILE', help='json build jobs configuration file')
+        'jobs', type=str, metavar='FILE', help='json build jobs configuration file, or a .jsonl stream of jobs as written by enumerate.py')
     args_parser.add_argument('-t', '--template', type=str, metavar="TEMPLATE",
                              help='jenkins job template, if not provided the default job template is pulled from the server', default=default_template)
     args_parser.add_argument('-s', '--server', type=str, metavar="URL",
                              help="jenkins server address url", default=default_server)
     args_parser.add_argument(
         '-y', '--no-prompt', help='Do not prompt for clean or query jobs', action='store_true', default=False)
+    args_parser.add_argument('--template-cache', type=str, metavar='DIR', default=None,
+                             help='keep the job templates in DIR and only revalidate them with the server')
+    args_parser.add_argument('--archive-cache', type=str, metavar='DIR', default=None,
+                             help='reuse the submission archives of unchanged sources, kept in DIR')
+    args_parser.add_argument('--archive-cache-size', type=float, metavar='GB', default=8,
+                             help='evict the least recently used archives once the archive cache grows over GB')
+    args_parser.add_argument('--hash-contents', action='store_true', default=False,
+                             help='key the archive cache by file contents and not only by size and modification time')
+    args_parser.add_argument('--stream', action='store_true', default=False,
+                             help='compress the sources while uploading them, without a temporary archive on disk (disables --archive-cache)')
+    args_parser.add_argument('--compression', type=str, choices=Compression.BACKENDS, default='gzip',
+                             help='compression of the submission archives, pgzip compresses on all cores and none sends a plain tar (the job template on the server must extract with tar -xf instead of tar -xzf, see template.xml)')
+    args_parser.add_argument('--compression-level', type=int, metavar='N', choices=range(1, 10), default=9,
+                             help='gzip compression level (1-9)')
+    args_parser.add_argument('-w', '--watch', action='store_true', default=False,
+                             help='do not run the operations, show a live status table of the jobs until they are done')
+    args_parser.add_argument('--poll-interval', type=float, metavar='SECONDS', default=5,
+                             help='shortest interval between two status polls of --watch')
+    args_parser.add_argument('-f', '--follow', action='store_true', default=False,
+                             help='query follows the console output of running builds until they finish, jobs are then run one at a time (not with -j)')
+    args_parser.add_argument('--console-offsets', type=str, metavar='FILE',
+                             default=JenkinsJob.DEFAULT_CACHE_DIR + '/console_offsets.json',
+                             help='file remembering how much console output query already printed')
+    args_parser.add_argument('--watch-state', type=str, metavar='FILE',
+                             default=JenkinsJob.DEFAULT_CACHE_DIR + '/watch_state.json',
+                             help='file remembering how much console output of the running builds --watch already parsed, and the stages reached')
+    args_parser.add_argument('-j', '--workers', type=int, metavar='N', default=1,
+                             help='number of jobs to submit concurrently, all prompts are answered before submission starts')
     args = args_parser.parse_args()
+    if args.follow and args.workers > 1:
+        # the output of concurrent jobs is buffered and printed once each job
+        # is done, a followed build would only show up after it finished
+        args_parser.error("--follow streams one build at a time, it cannot be used with -j")
 
-    with open(args.jobs, 'r') as build_config_file:
+    print("Reading build config:")
+    build_config = JobsFile(args.jobs)
 
-        print("Reading build config:")
-        build_config = json.load(build_config_file)
+    print("Username: " + build_config['username'])
+    if build_config.count != None:
+        print("There are %d jobs to submit" % build_config.count)
+    else:
+        print("Streaming the jobs to submit from %s" % args.jobs)
 
-        print("Username: " + build_config['username'])
-        print("There are %d jobs to submit" % (len(build_config['jobs'])))
+    jenkins_url = args.server
+    jenkins_server = JenkinsJob.getServer(jenkins_url,
+                                          username=build_config['username'], password=build_config['token'])
 
-        jenkins_url = args.server
-        jenkins_server = JenkinsJob.getServer(jenkins_url,
-                                              username=build_config['username'], password=build_config['token'])
+    user = build_config['username']
+    token = build_config['token']
+    JenkinsJob.template_cache = TemplateCache(args.template_cache)
+    JenkinsJob.console = ConsoleTail(args.console_offsets)
+    JenkinsJob.follow_console = args.follow
+    JenkinsJob.stream_archives = args.stream
+    JenkinsJob.compression = Compression(
+        args.compression, args.compression_level)
+    JenkinsJob.download_manager = DownloadManager(
+        user, token, workers=max(args.workers, 1))
+    JenkinsJob.uploader = SubmissionUploader(
+        user, token, pool_size=max(args.workers, 1))
+    if args.archive_cache != None:
+        JenkinsJob.archive_cache = ArchiveCache(args.archive_cache,
+                                                int(args.archive_cache_size * 1024 ** 3), args.hash_contents)
+    if args.watch:
+        StatusDashboard(jenkins_server, user,
+                        [JenkinsJob(job_info, args.no_prompt)
+                         for job_info in build_config.jobs()],
+                        min_interval=args.poll_interval, state_path=args.watch_state).watch()
+        sys.exit(0)
 
-        user = build_config['username']
-        token = build_config['token']
-        for job_info in build_config['jobs']:
+    print("Pulling the state of all the jobs of %s" % user)
+    JenkinsJob.snapshot = JobSnapshot(jenkins_server, user)
+    print("%d jobs found on the server" % len(JenkinsJob.snapshot))
+    if args.workers > 1:
+        pool = SubmissionPool(lambda: JenkinsJob.getServer(jenkins_url, username=user, password=token),
+                              user, token, args.template, args.workers)
+        # all the prompts are answered first, then the jobs are submitted in
+        # batches, so that a stream of jobs is not loaded into memory at once
+        answers = build_config.resolvePrompts(
+            lambda job_info: JenkinsJob(job_info, args.no_prompt),
+            lambda job: job.resolvePrompts(jenkins_server, user))
+
+        def submissionJobs():
+            for job_info in build_config.jobs():
+                job = JenkinsJob(job_info, args.no_prompt)
+                job.useAnswers(answers.get(job.name, {}))
+                yield job
+        jobs = submissionJobs()
+        submitted = 0
+        failed = []
+        while True:
+            results = pool.run(itertools.islice(jobs, args.workers * 64))
+            if len(results) == 0:
+                break
+            submitted += len(results)
+            failed += [r for r in results if not r['success']]
+        print("%d of %d jobs succeeded" %
+              (submitted - len(failed), submitted))
+        for result in failed:
+            printError("%s (%s) failed %s" % (result['name'], result['operation'],
+                                              result['error'] if result['error'] else ''))
+    else:
+        for job_info in build_config.jobs():
             JenkinsJob(job_info, args.no_prompt).submit(
                 jenkins_server, user, token, args.template)
-        print("All done. Visit %sjob/%s to query the status of your jobs." %
-              (jenkins_url, user))
+    print(JenkinsJob.template_cache.summary())
+    if JenkinsJob.archive_cache != None:
+        print(JenkinsJob.archive_cache.summary())
+    print("All done. Visit %sjob/%s to query the status of your jobs." %
+          (jenkins_url, user))
@@ -0,0 +1,186 @@
+import http.server
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import StreamblocksBuild
+
+
+"""
+SubmissionUploader against a stand-in jenkins, an http.server on localhost
+that records the multipart requests it gets and answers them as told
+"""
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+
+    def __read_body__(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers['Content-Length']))
+
+    def __parse__(self, body):
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        fields = {}
+        files = {}
+        for part in body.split(b'--' + boundary)[1:-1]:
+            (head, value) = part[2:-2].split(b'\r\n\r\n', 1)
+            disposition = head.split(b'\r\n')[0].decode()
+            name = disposition.split('name="')[1].split('"')[0]
+            if 'filename="' in disposition:
+                files[name] = (disposition.split('filename="')[1].split('"')[0], value)
+            else:
+                fields[name] = value.decode()
+        return (fields, files)
+
+    def do_POST(self):
+        server = self.server
+        answer = server.answers.pop(0) if server.answers else 201
+        (fields, files) = self.__parse__(self.__read_body__())
+        server.requests.append({
+            'fields': fields,
+            'files': files,
+            'chunked': self.headers.get('Transfer-Encoding') == 'chunked'
+        })
+        if answer == 'hang':
+            server.release.wait(5)
+            answer = 201
+        self.send_response(answer)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SubmissionUploaderTest(unittest.TestCase):
+
+    FIELDS = [('NETWORK_NAME', 'decoderDemo'),
+              ('PLATFORM', 'xilinx u250 xdma'),
+              ('HLS_CLOCK_PERIOD', '3.3')]
+    CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        self.server.answers = []
+        self.server.requests = []
+        self.server.release = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/job/u/job/a/buildWithParameters' % \
+            self.server.server_port
+        self.uploader = StreamblocksBuild.SubmissionUploader(
+            'user', 'token', retries=2, timeout=1)
+        (fd, self.path) = tempfile.mkstemp(suffix='.tar.gz')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(SubmissionUploaderTest.CONTENT)
+        # no backoff
+        self.sleep = mock.patch.object(StreamblocksBuild.time, 'sleep')
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.path)
+
+    def __check_request__(self, request, file_name):
+        self.assertEqual(request['fields'], dict(SubmissionUploaderTest.FIELDS))
+        self.assertEqual(request['files']['submission_file'],
+                         (file_name, SubmissionUploaderTest.CONTENT))
+
+    def test_file(self):
+        response = self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS,
+                                        'submission_file', self.path)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(self.server.requests[0]['chunked'])
+        self.__check_request__(self.server.requests[0], os.path.basename(self.path))
+
+    def test_stream(self):
+        response = self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS, 'submission_file',
+                                        open_stream=lambda: io.BytesIO(SubmissionUploaderTest.CONTENT),
+                                        file_name='a.tar.gz')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(self.server.requests[0]['chunked'])
+        self.__check_request__(self.server.requests[0], 'a.tar.gz')
+
+    def test_retry_when_not_queued(self):
+        self.server.answers = [503]
+        streams = []
+
+        def open_stream():
+            streams.append(io.BytesIO(SubmissionUploaderTest.CONTENT))
+            return streams[-1]
+        response = self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS, 'submission_file',
+                                        open_stream=open_stream, file_name='a.tar.gz',
+                                        queued=lambda: False)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.server.requests), 2)
+        # every attempt reads a fresh stream
+        self.assertEqual(len(streams), 2)
+        for request in self.server.requests:
+            self.__check_request__(request, 'a.tar.gz')
+
+    def test_no_retry_when_queued(self):
+        self.server.answers = [502]
+        response = self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS,
+                                        'submission_file', self.path, queued=lambda: True)
+        self.assertEqual(response, None)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_retry_without_queued(self):
+        self.server.answers = [504]
+        with self.assertRaises(RuntimeError):
+            self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS,
+                                 'submission_file', self.path)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_retry_on_server_error(self):
+        self.server.answers = [500]
+        with self.assertRaises(requests.HTTPError):
+            self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS,
+                                 'submission_file', self.path, queued=lambda: False)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_read_timeout_checks_queue(self):
+        self.server.answers = ['hang']
+        checks = []
+
+        def queued():
+            checks.append(True)
+            return True
+        response = self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS,
+                                        'submission_file', self.path, queued=queued)
+        self.assertEqual(response, None)
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retry_connection_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        checks = []
+        with self.assertRaises(RuntimeError):
+            self.uploader.upload(self.url, SubmissionUploaderTest.FIELDS, 'submission_file',
+                                 self.path, queued=lambda: checks.append(True))
+        # nothing reached the server, no need to ask
+        self.assertEqual(checks, [])
+        self.assertEqual(StreamblocksBuild.time.sleep.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()